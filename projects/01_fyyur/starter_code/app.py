@@ -2,39 +2,93 @@
 # Imports
 #----------------------------------------------------------------------------#
 
+import base64
+import csv
+import io
 import json
-from datetime import datetime
+import mimetypes
+import os
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from collections import Counter
+from itertools import groupby
 from flask_migrate import Migrate
 import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+import babel.dates
+import click
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, \
+  abort, stream_with_context, session, g, has_request_context, send_from_directory
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
-import logging
-from logging import Formatter, FileHandler
+from jinja2 import FileSystemBytecodeCache
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
 from flask_wtf import Form
 from forms import *
+from search import InvertedIndex, tokenize
+from cache import create_cache
+from sql_profiler import SQLProfiler
+from async_logging import setup_logging
+from assets import BUNDLES, DIST_DIR, build_assets, load_manifest
+from bulk_import import compile_rules, import_rows, read_rows
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
 
+class RoutingSession(SignallingSession):
+  """
+  Sends the queries of the views marked @read_only to the replica picked
+  for the request. Flushes, and so every write, stay on the primary.
+  """
+
+  def get_bind(self, mapper=None, clause=None):
+    replica = g.get('replica') if has_request_context() else None
+    if replica is not None and not self._flushing:
+      return db.get_engine(self.app, bind=replica)
+    return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 
 migrate = Migrate(app, db)
+page_cache = create_cache(app.config)
+sql_profiler = SQLProfiler(app)
 
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
+# Postgres arrays fall back to JSON so the tests can run against SQLite.
+StringArray = db.ARRAY(db.String).with_variant(db.JSON, 'sqlite')
+DateTimeArray = db.ARRAY(db.DateTime).with_variant(db.JSON, 'sqlite')
+# SQLite searches through the in-process InvertedIndex instead.
+SearchVector = TSVECTOR().with_variant(db.Text, 'sqlite')
+
 class Venue(db.Model):
     __tablename__ = 'Venue'
+    __table_args__ = (
+        db.Index('ix_venue_search_vector', 'search_vector',
+            postgresql_using='gin'),
+        db.Index('ix_venue_state_city', 'state', 'city'),
+        db.Index('ix_venue_name', 'name'),
+        db.Index('ix_venue_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String))
+    genres = db.Column(StringArray)
     website = db.Column(db.String())
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
@@ -47,6 +101,13 @@ class Venue(db.Model):
     image_link = db.Column(db.String())
     shows = db.relationship('Show',
         backref=db.backref('Venue', lazy=True))
+    # Maintained by count_show() and refresh_show_counters()
+    upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0,
+        server_default='0')
+    past_shows_count = db.Column(db.Integer, nullable=False, default=0,
+        server_default='0')
+    # Maintained by index_for_search()
+    search_vector = db.Column(SearchVector)
     
     def __repr__(self):
       return f'<Venue {self.id} name: {self.name}>'
@@ -54,13 +115,19 @@ class Venue(db.Model):
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
+    __table_args__ = (
+        db.Index('ix_artist_search_vector', 'search_vector',
+            postgresql_using='gin'),
+        db.Index('ix_artist_name', 'name'),
+        db.Index('ix_artist_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
-    genres = db.Column(db.ARRAY(db.String))
+    genres = db.Column(StringArray)
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     website = db.Column(db.String())
@@ -69,11 +136,24 @@ class Artist(db.Model):
     image_link = db.Column(db.String())
     shows = db.relationship('Show',
         backref=db.backref('Artist', lazy=True))
-    availability = db.Column(db.ARRAY(db.DateTime))
+    # Maintained by count_show() and refresh_show_counters()
+    upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0,
+        server_default='0')
+    past_shows_count = db.Column(db.Integer, nullable=False, default=0,
+        server_default='0')
+    # Maintained by index_for_search()
+    search_vector = db.Column(SearchVector)
+    # Superseded by the Availability table, see migrate-availability
+    availability = db.Column(DateTimeArray)
 
 
 class Show(db.Model):
   __tablename__ = 'Show'
+  __table_args__ = (
+    db.Index('ix_show_venue_id_start_time', 'venue_id', 'start_time'),
+    db.Index('ix_show_artist_id_start_time', 'artist_id', 'start_time'),
+    db.Index('ix_show_start_time_id', 'start_time', 'id'),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   start_time = db.Column(db.DateTime)
@@ -82,20 +162,874 @@ class Show(db.Model):
   venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'),
         nullable=False)
 
+
+class Availability(db.Model):
+  """A time range in which an artist can be booked. Slots never overlap."""
+  __tablename__ = 'Availability'
+  __table_args__ = (
+    db.Index('ix_availability_artist_id_start_time', 'artist_id', 'start_time'),
+  )
+
+  id = db.Column(db.Integer, primary_key=True)
+  artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'),
+        nullable=False)
+  start_time = db.Column(db.DateTime, nullable=False)
+  end_time = db.Column(db.DateTime, nullable=False)
+
+
+class FacetCount(db.Model):
+  """How many venues or artists carry a genre, state or city"""
+  __tablename__ = 'FacetCount'
+
+  # Venue or Artist
+  kind = db.Column(db.String(20), primary_key=True)
+  # genre, state or city
+  facet = db.Column(db.String(20), primary_key=True)
+  value = db.Column(db.String(120), primary_key=True)
+  # Maintained by update_facets() and rebuild_facets()
+  count = db.Column(db.Integer, nullable=False, default=0)
+
+#----------------------------------------------------------------------------#
+# Replicas.
+#----------------------------------------------------------------------------#
+
+def replica_binds():
+  return [bind for bind in app.config.get('SQLALCHEMY_BINDS') or {}
+    if bind.startswith('replica_')]
+
+def choose_replica():
+  """A random replica, or None when the request must read the primary"""
+  replicas = replica_binds()
+  if not replicas or session.get('primary_until', 0) > time.time():
+    return None
+  return random.choice(replicas)
+
+def read_only(view):
+  """Lets the queries of a view that never writes go to a read replica"""
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    g.replica = choose_replica()
+    return view(*args, **kwargs)
+  return wrapper
+
+@app.before_request
+def use_primary():
+  # g outlives the request when an app context was already pushed
+  g.pop('replica', None)
+
+@app.after_request
+def stick_to_primary(response):
+  """After a write, reads of the same client go to the primary for a while"""
+  if request.method not in ('GET', 'HEAD') and 'replica' not in g \
+      and replica_binds():
+    session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+  return response
+
+#----------------------------------------------------------------------------#
+# IDs.
+#----------------------------------------------------------------------------#
+
+# Primary keys come from the database (SERIAL on Postgres), so concurrent
+# inserts never collide. Only the SQLite fallback below needs a lock and
+# the next free id per table, since allocated blocks are not committed yet.
+id_block_lock = threading.Lock()
+next_free_ids = {}
+
+def allocate_ids(model, count: int):
+  """
+  Reserves `count` primary keys for `model` in one round trip, for bulk
+  inserts that need to know their ids up front.
+  """
+  if count <= 0:
+    return []
+  table = model.__table__
+  if db.engine.dialect.name == 'postgresql':
+    rows = db.session.execute(db.text(
+      'SELECT nextval(pg_get_serial_sequence(:table, :column)) '
+      'FROM generate_series(1, :count)'),
+      {'table': f'"{table.name}"', 'column': 'id', 'count': count})
+    return [id for id, in rows]
+  # SQLite has no sequences and allows a single writer, which is the
+  # process holding the lock here.
+  with id_block_lock:
+    start = (db.session.query(db.func.max(table.c.id)).scalar() or 0) + 1
+    start = max(start, next_free_ids.get(table.name, 0))
+    next_free_ids[table.name] = start + count
+    return list(range(start, start + count))
+
+def bulk_insert(model, rows):
+  """
+  Inserts a list of column dicts with a single executemany and returns
+  their ids, allocating them in one block when the rows have none.
+  """
+  missing = [row for row in rows if row.get('id') is None]
+  for row, id in zip(missing, allocate_ids(model, len(missing))):
+    row['id'] = id
+  if rows:
+    db.session.execute(model.__table__.insert(), rows)
+  return [row['id'] for row in rows]
+
+@app.cli.command('sync-id-sequences')
+def sync_id_sequences_command():
+  """Moves the Postgres id sequences past ids inserted by hand."""
+  for model in (Venue, Artist, Show):
+    db.session.execute(db.text(
+      'SELECT setval(pg_get_serial_sequence(:table, :column), '
+      f'COALESCE((SELECT MAX(id) FROM "{model.__tablename__}"), 0) + 1, false)'),
+      {'table': f'"{model.__tablename__}"', 'column': 'id'})
+  db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Show counters.
+#----------------------------------------------------------------------------#
+
+def count_show(show: Show, delta=1):
+  """
+  Adds `delta` to the upcoming or past counter of the show's venue and
+  artist. Call it in the same transaction that creates (delta=1) or
+  deletes (delta=-1) the show.
+  """
+  upcoming = show.start_time > datetime.now()
+  for model, id in ((Venue, show.venue_id), (Artist, show.artist_id)):
+    column = model.upcoming_shows_count if upcoming else model.past_shows_count
+    model.query.filter_by(id=id).update({column: column + delta},
+      synchronize_session=False)
+
+def refresh_show_counters(venue_ids=None, artist_ids=None):
+  """
+  Recomputes the counters from the Show table. Without ids every row is
+  refreshed, which is how the counters are backfilled. The update is
+  idempotent, so overlapping roll-forward runs are harmless.
+  """
+  now = datetime.now()
+  for model, key, ids in ((Venue, Show.venue_id, venue_ids),
+                          (Artist, Show.artist_id, artist_ids)):
+    shows = db.session.query(db.func.count(Show.id)).filter(key == model.id)
+    query = model.query
+    if ids is not None:
+      if not ids:
+        continue
+      query = query.filter(model.id.in_(ids))
+    query.update({
+      model.upcoming_shows_count: shows.filter(Show.start_time > now).as_scalar(),
+      model.past_shows_count: shows.filter(Show.start_time <= now).as_scalar()
+    }, synchronize_session=False)
+
+def roll_show_counters(since: datetime):
+  """
+  Moves the shows that started between `since` and now from the upcoming to
+  the past counters by refreshing only the venues and artists they belong to.
+  Returns the ids of the refreshed venues and artists.
+  """
+  started = Show.query.filter(Show.start_time > since,
+    Show.start_time <= datetime.now())
+  venue_ids = {id for id, in started.with_entities(Show.venue_id).distinct()}
+  artist_ids = {id for id, in started.with_entities(Show.artist_id).distinct()}
+  refresh_show_counters(venue_ids, artist_ids)
+  return venue_ids, artist_ids
+
+@app.cli.command('roll-show-counters')
+@click.option('--hours', default=1, help='How far back to look for shows that started.')
+@click.option('--all', 'refresh_all', is_flag=True, help='Recompute every counter.')
+def roll_show_counters_command(hours, refresh_all):
+  """
+  Periodic job that keeps the show counters in sync with the clock. The
+  pages showing them are dropped from a shared (redis) page cache, the lru
+  cache of the running workers only catches up when its pages expire.
+  """
+  if refresh_all:
+    refresh_show_counters()
+    db.session.commit()
+    page_cache.clear()
+    return
+  venue_ids, artist_ids = roll_show_counters(datetime.now() - timedelta(hours=hours))
+  db.session.commit()
+  page_cache.invalidate('venues', *(f'venue:{id}' for id in venue_ids),
+    *(f'artist:{id}' for id in artist_ids))
+  click.echo(f'Refreshed {len(venue_ids)} venues and {len(artist_ids)} artists')
+
+#----------------------------------------------------------------------------#
+# Booking.
+#----------------------------------------------------------------------------#
+
+def add_availability(artist_id: int, start_time: datetime, end_time: datetime):
+  """
+  Adds a bookable range for the artist, merging it with the slots it
+  overlaps or touches so that slots stay disjoint.
+  """
+  overlapping = Availability.query.filter(
+    Availability.artist_id == artist_id,
+    Availability.start_time <= end_time,
+    Availability.end_time >= start_time).all()
+  for slot in overlapping:
+    start_time = min(start_time, slot.start_time)
+    end_time = max(end_time, slot.end_time)
+    db.session.delete(slot)
+  slot = Availability(artist_id=artist_id, start_time=start_time, end_time=end_time)
+  db.session.add(slot)
+  return slot
+
+def is_artist_available(artist_id: int, start_time: datetime):
+  """
+  True if one slot covers the whole show. Slots are disjoint, so only the
+  last slot starting before the show can, which is one index probe.
+  """
+  slot = Availability.query.filter(
+    Availability.artist_id == artist_id,
+    Availability.start_time <= start_time
+  ).order_by(Availability.start_time.desc()).first()
+  return slot is not None and slot.end_time >= start_time + app.config['SHOW_DURATION']
+
+def is_booked(column, id: int, start_time: datetime):
+  """True if a show of the venue or artist (`column`) overlaps `start_time`"""
+  duration = app.config['SHOW_DURATION']
+  return db.session.query(Show.query.filter(
+    column == id,
+    Show.start_time > start_time - duration,
+    Show.start_time < start_time + duration).exists()).scalar()
+
+def booking_conflicts(artist_id: int, venue_id: int, start_time: datetime):
+  """Lists why a show cannot be booked, empty when it can"""
+  conflicts = []
+  if not is_artist_available(artist_id, start_time):
+    conflicts.append('Artist not available at that time')
+  elif is_booked(Show.artist_id, artist_id, start_time):
+    conflicts.append('Artist already plays another show at that time')
+  if is_booked(Show.venue_id, venue_id, start_time):
+    conflicts.append('Venue is already booked at that time')
+  return conflicts
+
+def parse_request_time(value: str):
+  """
+  Parses a time sent by a client. Stored times carry no timezone, so
+  one with a timezone cannot be compared to them and is a ValueError.
+  """
+  parsed = dateutil.parser.parse(value)
+  if parsed.tzinfo is not None:
+    raise ValueError('Times with a timezone are not supported')
+  return parsed
+
+# Held while checking and then inserting shows, so two requests of this
+# process cannot both book the same slot. lock_bookings() does the same
+# across processes on Postgres.
+booking_lock = threading.Lock()
+
+def lock_bookings(artist_ids, venue_ids):
+  """
+  Locks the rows of the artists and venues about to get shows until the
+  transaction ends, so concurrent bookings for them wait for each other.
+  Always in id order, to not deadlock. A no-op on SQLite, which has no row
+  locks, where booking_lock is what serializes bookings.
+  """
+  for model, ids in ((Artist, artist_ids), (Venue, venue_ids)):
+    db.session.query(model.id).filter(model.id.in_(sorted(set(ids)))) \
+      .order_by(model.id).with_for_update().all()
+
+def count_overlapping(times, start_time: datetime):
+  """Counts the shows in a sorted list of start times overlapping start_time"""
+  duration = app.config['SHOW_DURATION']
+  return bisect_left(times, start_time + duration) - \
+    bisect_right(times, start_time - duration)
+
+def check_schedule(proposals, in_order=False):
+  """
+  Batch version of booking_conflicts() for a list of (artist_id, venue_id,
+  start_time) proposals. Loads the slots and shows of every artist and
+  venue involved in three queries, then checks each proposal with binary
+  searches, including clashes between the proposals themselves. Clashing
+  proposals flag each other, or with `in_order` only the later one, as if
+  the earlier ones without conflicts were already booked.
+  """
+  if not proposals:
+    return []
+  duration = app.config['SHOW_DURATION']
+  artist_ids = {artist_id for artist_id, _, _ in proposals}
+  venue_ids = {venue_id for _, venue_id, _ in proposals}
+  start = min(start_time for _, _, start_time in proposals) - duration
+  end = max(start_time for _, _, start_time in proposals) + duration
+
+  slots = {artist_id: ([], []) for artist_id in artist_ids}
+  for artist_id, slot_start, slot_end in db.session.query(
+      Availability.artist_id, Availability.start_time, Availability.end_time
+    ).filter(Availability.artist_id.in_(artist_ids),
+      Availability.end_time >= start, Availability.start_time <= end
+    ).order_by(Availability.start_time):
+    slots[artist_id][0].append(slot_start)
+    slots[artist_id][1].append(slot_end)
+
+  def show_times(column, ids):
+    times = {id: [] for id in ids}
+    for id, start_time in db.session.query(column, Show.start_time).filter(
+        column.in_(ids), Show.start_time > start, Show.start_time < end
+      ).order_by(Show.start_time):
+      times[id].append(start_time)
+    return times
+  artist_shows = show_times(Show.artist_id, artist_ids)
+  venue_shows = show_times(Show.venue_id, venue_ids)
+  # Every proposal is booked too, so clashing proposals flag each other
+  if not in_order:
+    for artist_id, venue_id, start_time in proposals:
+      insort(artist_shows[artist_id], start_time)
+      insort(venue_shows[venue_id], start_time)
+
+  results = []
+  for artist_id, venue_id, start_time in proposals:
+    if in_order:
+      insort(artist_shows[artist_id], start_time)
+      insort(venue_shows[venue_id], start_time)
+    conflicts = []
+    starts, ends = slots[artist_id]
+    position = bisect_right(starts, start_time) - 1
+    if position < 0 or ends[position] < start_time + duration:
+      conflicts.append('Artist not available at that time')
+    elif count_overlapping(artist_shows[artist_id], start_time) > 1:
+      conflicts.append('Artist already plays another show at that time')
+    if count_overlapping(venue_shows[venue_id], start_time) > 1:
+      conflicts.append('Venue is already booked at that time')
+    if in_order and conflicts:
+      artist_shows[artist_id].remove(start_time)
+      venue_shows[venue_id].remove(start_time)
+    results.append(conflicts)
+  return results
+
+@app.route('/shows/check', methods=['POST'])
+def check_shows():
+  """Checks a JSON list of {artist_id, venue_id, start_time} proposals"""
+  try:
+    proposals = [(int(show['artist_id']), int(show['venue_id']),
+      parse_request_time(show['start_time'])) for show in request.get_json()]
+  except (KeyError, TypeError, ValueError, OverflowError):
+    abort(400)
+  return jsonify([{'conflicts': conflicts}
+    for conflicts in check_schedule(proposals)])
+
+@app.route('/artists/<int:artist_id>/availability', methods=['POST'])
+def add_artist_availability(artist_id):
+  try:
+    data = request.get_json()
+    start_time = parse_request_time(data['start_time'])
+    end_time = parse_request_time(data['end_time'])
+  except (KeyError, TypeError, ValueError, OverflowError):
+    abort(400)
+  if end_time <= start_time or Artist.query.get(artist_id) is None:
+    abort(400)
+  slot = add_availability(artist_id, start_time, end_time)
+  db.session.commit()
+  return jsonify({'start_time': slot.start_time.isoformat(),
+    'end_time': slot.end_time.isoformat()})
+
+@app.cli.command('migrate-availability')
+def migrate_availability_command():
+  """Copies Artist.availability timestamps into Availability slots."""
+  artists = Artist.query.filter(Artist.availability.isnot(None))
+  for artist in artists:
+    for start_time in artist.availability:
+      add_availability(artist.id, start_time, start_time + app.config['SHOW_DURATION'])
+      db.session.flush()
+  db.session.commit()
+
+#----------------------------------------------------------------------------#
+# Search.
+#----------------------------------------------------------------------------#
+
+SEARCH_RESULTS_PER_PAGE = 20
+TYPEAHEAD_RESULTS = 10
+SEARCH_WEIGHTS = {'name': 'A', 'city': 'B', 'genres': 'C'}
+# Only used when the database has no full-text search (SQLite)
+search_indexes = {}
+
+def search_fields(entity):
+  return {
+    'name': entity.name,
+    'city': f'{entity.city or ""} {entity.state or ""}',
+    'genres': ' '.join(entity.genres or [])
+  }
+
+def uses_full_text_search():
+  return db.engine.dialect.name == 'postgresql'
+
+def get_search_index(model):
+  """Builds the in-process index for `model` on first use"""
+  index = search_indexes.get(model)
+  if index is None:
+    index = InvertedIndex({'name': 3, 'city': 2, 'genres': 1})
+    columns = model.query.with_entities(model.id, model.name, model.city,
+      model.state, model.genres)
+    for entity in columns.yield_per(1000):
+      index.add(entity.id, search_fields(entity))
+    search_indexes[model] = index
+  return index
+
+def build_search_vector(fields):
+  """Weighted tsvector over field -> text, where text may be a SQL expression"""
+  vectors = [
+    db.func.setweight(db.func.to_tsvector('simple', text), SEARCH_WEIGHTS[field])
+    for field, text in fields.items()
+  ]
+  vector = vectors[0]
+  for other in vectors[1:]:
+    vector = vector.op('||')(other)
+  return vector
+
+def index_for_search(entity):
+  """
+  Keeps the search index in sync with a created or edited Venue/Artist.
+  Call it after the entity is flushed, in the transaction that writes it.
+  """
+  if uses_full_text_search():
+    entity.search_vector = build_search_vector(search_fields(entity))
+  elif type(entity) in search_indexes:
+    search_indexes[type(entity)].add(entity.id, search_fields(entity))
+
+def reindex_for_search(model, ids):
+  """Same as index_for_search() for rows written without the ORM"""
+  if uses_full_text_search():
+    vector = build_search_vector({
+      'name': db.func.coalesce(model.name, ''),
+      'city': db.func.concat_ws(' ', model.city, model.state),
+      'genres': db.func.coalesce(db.func.array_to_string(model.genres, ' '), '')
+    })
+    model.query.filter(model.id.in_(ids)).update({model.search_vector: vector},
+      synchronize_session=False)
+  else:
+    # Rebuilt from the table on the next search
+    search_indexes.pop(model, None)
+
+def unindex_for_search(model, id: int):
+  if model in search_indexes:
+    search_indexes[model].remove(id)
+
+def search_entities(model, search_term: str, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+  """
+  Ranked search over name, city/state and genres. Every word of the term is
+  matched as a prefix. Returns (total, entities) for the requested page.
+  """
+  tokens = tokenize(search_term)
+  offset = (page - 1) * per_page
+  if not tokens:
+    query = model.query.order_by(model.name, model.id)
+    return query.count(), query.offset(offset).limit(per_page).all()
+  if uses_full_text_search():
+    ts_query = db.func.to_tsquery('simple',
+      ' & '.join(token + ':*' for token in tokens))
+    query = model.query.filter(model.search_vector.op('@@')(ts_query))
+    rank = db.func.ts_rank(model.search_vector, ts_query)
+    return query.count(), query.order_by(rank.desc(), model.id) \
+      .offset(offset).limit(per_page).all()
+  total, ids = get_search_index(model).search(search_term, offset, per_page)
+  entities = {entity.id: entity
+    for entity in model.query.filter(model.id.in_(ids))}
+  return total, [entities[id] for id in ids if id in entities]
+
+def search_response(model):
+  search_term = request.values.get('search_term', '')
+  page = request.values.get('page', 1, type=int)
+  # A negative OFFSET is an error on Postgres
+  if page < 1:
+    abort(400)
+  total, results = search_entities(model, search_term, page)
+  response = {
+    'count': total,
+    'next_page': page + 1 if page * SEARCH_RESULTS_PER_PAGE < total else None,
+    'data': [get_formatted_info(entity) for entity in results]
+  }
+  return response, search_term
+
+def typeahead_response(model):
+  _, results = search_entities(model, request.args.get('q', ''),
+    per_page=TYPEAHEAD_RESULTS)
+  return jsonify([{'id': entity.id, 'name': entity.name}
+    for entity in results])
+
+#----------------------------------------------------------------------------#
+# Facets.
+#----------------------------------------------------------------------------#
+
+BROWSE_MODELS = {'venues': Venue, 'artists': Artist}
+BROWSE_RESULTS_PER_PAGE = 20
+
+def facet_values(genres, state, city):
+  """The (facet, value) pairs a venue or an artist is counted under"""
+  values = {('genre', genre) for genre in genres or [] if genre}
+  if state:
+    values.add(('state', state))
+  if city:
+    values.add(('city', city))
+  return values
+
+def entity_facets(entity):
+  return facet_values(entity.genres, entity.state, entity.city)
+
+def update_facets(model, old=(), new=()):
+  """
+  Moves the facet counts of `model` from the `old` (facet, value) pairs to
+  the `new` ones. Both may repeat pairs, such as the pairs of a whole import
+  batch, or be Counters of them. Call it in the transaction that writes the rows.
+  """
+  deltas = Counter(new)
+  deltas.subtract(Counter(old))
+  rows = [{'kind': model.__tablename__, 'facet': facet, 'value': value,
+           'count': delta}
+          for (facet, value), delta in deltas.items() if delta]
+  if not rows:
+    return
+  if db.engine.dialect.name == 'postgresql':
+    # A single upsert, so concurrent writers of a new value cannot collide
+    statement = pg_insert(FacetCount.__table__).values(rows)
+    db.session.execute(statement.on_conflict_do_update(
+      index_elements=['kind', 'facet', 'value'],
+      set_={'count': FacetCount.__table__.c.count + statement.excluded.count}))
+    return
+  for row in rows:
+    updated = FacetCount.query.filter_by(kind=row['kind'], facet=row['facet'],
+      value=row['value']).update({FacetCount.count: FacetCount.count + row['count']},
+      synchronize_session=False)
+    if not updated:
+      db.session.execute(FacetCount.__table__.insert(), row)
+
+def rebuild_facets(model):
+  """Recounts every facet of `model` from its table, which backfills them"""
+  FacetCount.query.filter_by(kind=model.__tablename__).delete()
+  columns = db.session.query(model.genres, model.state, model.city)
+  counts = Counter()
+  for genres, state, city in columns.yield_per(1000):
+    counts.update(facet_values(genres, state, city))
+  update_facets(model, new=counts)
+
+@app.cli.command('rebuild-facets')
+def rebuild_facets_command():
+  """Recounts the browse facets of venues and artists."""
+  for model in BROWSE_MODELS.values():
+    rebuild_facets(model)
+  db.session.commit()
+
+def get_facets(model):
+  """facet -> [{value, count}], most common values first"""
+  rows = FacetCount.query.filter(FacetCount.kind == model.__tablename__,
+    FacetCount.count > 0).order_by(FacetCount.facet,
+    FacetCount.count.desc(), FacetCount.value)
+  facets = {'genre': [], 'state': [], 'city': []}
+  for row in rows:
+    facets[row.facet].append({'value': row.value, 'count': row.count})
+  return facets
+
+def has_genre(model, genre: str):
+  """Filter on one genre that can use the GIN index on Postgres"""
+  if db.engine.dialect.name == 'postgresql':
+    return model.genres.contains([genre])
+  # SQLite stores the genres as a JSON list
+  return db.text(f'EXISTS (SELECT 1 FROM json_each("{model.__tablename__}".genres) '
+    'WHERE json_each.value = :genre)').bindparams(
+      # Unique, so several genre filters in one query keep their own value
+      db.bindparam('genre', genre, unique=True))
+
+def browse_entities(model, genres=(), state=None, city=None, after=None,
+                    limit=BROWSE_RESULTS_PER_PAGE):
+  """
+  Venues or artists carrying every genre in `genres` and in the given
+  state and city, ordered by id. Pages are keyed by the last id seen.
+  """
+  query = model.query
+  for genre in genres:
+    query = query.filter(has_genre(model, genre))
+  if state:
+    query = query.filter(model.state == state)
+  if city:
+    query = query.filter(model.city == city)
+  if after is not None:
+    query = query.filter(model.id > after)
+  return query.order_by(model.id).limit(limit).all()
+
+@app.route('/browse/<kind>')
+@read_only
+def browse(kind):
+  """Filtered venues or artists plus the facet counts for the sidebar"""
+  model = BROWSE_MODELS.get(kind)
+  if model is None:
+    abort(404)
+  limit = BROWSE_RESULTS_PER_PAGE
+  entities = browse_entities(model, request.args.getlist('genre'),
+    request.args.get('state'), request.args.get('city'),
+    request.args.get('after', type=int), limit + 1)
+  data = [{
+    'id': entity.id,
+    'name': entity.name,
+    'city': entity.city,
+    'state': entity.state,
+    'genres': entity.genres,
+    'num_upcoming_shows': entity.upcoming_shows_count
+  } for entity in entities[:limit]]
+  return jsonify({
+    'facets': get_facets(model),
+    'data': data,
+    'next_after': data[-1]['id'] if len(entities) > limit else None
+  })
+
+#----------------------------------------------------------------------------#
+# Bulk import.
+#----------------------------------------------------------------------------#
+
+IMPORTS = {
+  'venues': (Venue, VenueForm),
+  'artists': (Artist, ArtistForm),
+  'shows': (Show, ShowForm),
+}
+
+def check_show_ids():
+  """Rejects shows whose artist or venue does not exist"""
+  known_ids = {
+    'artist_id': {id for id, in db.session.query(Artist.id)},
+    'venue_id': {id for id, in db.session.query(Venue.id)}
+  }
+  def check(values):
+    errors = {}
+    for key, ids in known_ids.items():
+      try:
+        values[key] = int(values[key])
+      except (TypeError, ValueError):
+        errors[key] = ['Not a valid id.']
+        continue
+      if values[key] not in ids:
+        errors[key] = ['Unknown id.']
+    return errors
+  return check
+
+def run_import(kind: str, rows):
+  """
+  Validates rows with the rules of the matching form and inserts them in
+  batches, one transaction per batch. Returns the per-row error report.
+  """
+  model, form_class = IMPORTS[kind]
+  check = check_show_ids() if model is Show else None
+  venue_ids = set()
+  artist_ids = set()
+
+  def insert(batch):
+    errors = None
+    try:
+      if model is Show:
+        # Checked and inserted in one transaction, like create_show_submission
+        with booking_lock:
+          lock_bookings([values['artist_id'] for values in batch],
+            [values['venue_id'] for values in batch])
+          errors = [{'start_time': conflicts} if conflicts else {}
+            for conflicts in check_schedule([(values['artist_id'],
+              values['venue_id'], values['start_time']) for values in batch],
+              in_order=True)]
+          batch = [values for values, error in zip(batch, errors) if not error]
+          bulk_insert(model, batch)
+          db.session.commit()
+        return errors
+      ids = bulk_insert(model, batch)
+      reindex_for_search(model, ids)
+      update_facets(model, new=[pair for values in batch
+        for pair in facet_values(values.get('genres'), values.get('state'),
+          values.get('city'))])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+    finally:
+      if model is Show:
+        venue_ids.update(values['venue_id'] for values in batch)
+        artist_ids.update(values['artist_id'] for values in batch)
+
+  report = import_rows(rows, compile_rules(form_class), insert, check)
+  if model is Show:
+    refresh_show_counters(venue_ids, artist_ids)
+    db.session.commit()
+  page_cache.clear()
+  return report
+
+def import_format(filename: str, content_type=None):
+  if filename.endswith('.csv') or content_type == 'text/csv':
+    return 'csv'
+  return 'jsonl'
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(IMPORTS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']),
+  help='Defaults to the file extension.')
+def import_data_command(kind, path, format):
+  """Bulk imports venues, artists or shows from CSV or JSON Lines."""
+  with open(path, newline='', encoding='utf-8') as stream:
+    report = run_import(kind, read_rows(stream, format or import_format(path)))
+  for error in report['errors']:
+    click.echo(f"line {error['line']}: {json.dumps(error['errors'])}", err=True)
+  click.echo(f"Imported {report['imported']} {kind}, rejected {report['rejected']}")
+
+@app.route('/import/<kind>', methods=['POST'])
+def import_data(kind):
+  """Streams a CSV or JSON Lines request body into the database"""
+  if kind not in IMPORTS:
+    abort(404)
+  format = request.args.get('format') or import_format('', request.mimetype)
+  if format not in ('csv', 'jsonl'):
+    abort(400)
+  stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+  try:
+    report = run_import(kind, read_rows(stream, format))
+  except (ValueError, csv.Error):
+    abort(400)
+  return jsonify(report)
+
+#----------------------------------------------------------------------------#
+# Page cache.
+#----------------------------------------------------------------------------#
+
+def cached_page(key: str, render):
+  """
+  Serves the page stored under `key`, calling `render` on a miss. `render`
+  returns the html and how many seconds it stays valid (None for the
+  default, 0 to not store it). Requests with pending flash messages skip
+  the cache, because the layout renders those messages. Pages rendered from
+  a replica are not stored, it may be behind a write that just invalidated
+  them and would hand the stale page to its writer too.
+  """
+  if '_flashes' in session:
+    return render()[0]
+  html = page_cache.get(key)
+  if html is None:
+    html, timeout = render()
+    if timeout != 0 and not g.get('replica'):
+      if timeout is None:
+        timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+      page_cache.set(key, html, timeout)
+  return html
+
+def timeline_timeout(shows):
+  """A detail page goes stale when its next upcoming show starts"""
+  now = datetime.now()
+  timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+  upcoming = [show.start_time for show in shows if show.start_time > now]
+  if upcoming:
+    timeout = min(timeout, (min(upcoming) - now).total_seconds())
+  return timeout
+
+def invalidate_venue(venue_id):
+  """Drops the pages showing the venue, including its artists' pages"""
+  artist_ids = db.session.query(Show.artist_id) \
+    .filter_by(venue_id=venue_id).distinct()
+  page_cache.invalidate('venues', f'venue:{venue_id}',
+    *(f'artist:{id}' for id, in artist_ids))
+
+def invalidate_artist(artist_id):
+  """Drops the pages showing the artist, including its venues' pages"""
+  venue_ids = db.session.query(Show.venue_id) \
+    .filter_by(artist_id=artist_id).distinct()
+  page_cache.invalidate('artists', f'artist:{artist_id}',
+    *(f'venue:{id}' for id, in venue_ids))
+
+@app.route('/metrics/cache')
+def cache_metrics():
+  return jsonify(page_cache.stats())
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format)
+DATETIME_FORMATS = {
+  'full': "EEEE MMMM, d, y 'at' h:mma",
+  'medium': "EE MM, dd, y h:mma"
+}
+
+@lru_cache(maxsize=64)
+def get_datetime_pattern(format: str, locale: str):
+  """Parses a babel pattern and its locale once per (format, locale)"""
+  pattern = babel.dates.parse_pattern(DATETIME_FORMATS.get(format, format))
+  return pattern, babel.Locale.parse(locale)
+
+def format_datetime(value, format='medium', locale=babel.dates.LC_TIME):
+  """Formats a datetime, or a string holding one, with a cached pattern"""
+  if not isinstance(value, datetime):
+    value = dateutil.parser.parse(value)
+  pattern, locale = get_datetime_pattern(format, locale)
+  return pattern.apply(value, locale)
+
+def format_datetimes(values, format='medium', locale=babel.dates.LC_TIME):
+  """Formats a whole column of datetimes, looking the pattern up only once"""
+  pattern, locale = get_datetime_pattern(format, locale)
+  return [pattern.apply(value if isinstance(value, datetime)
+    else dateutil.parser.parse(value), locale) for value in values]
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+#----------------------------------------------------------------------------#
+# Templates.
+#----------------------------------------------------------------------------#
+
+# Jinja compiles a template the first time a process renders it. Workers that
+# share a bytecode cache, filled ahead of time by compile-templates, only
+# unmarshal the compiled code instead.
+
+def template_names():
+  return app.jinja_env.list_templates(extensions=['html'])
+
+def use_template_cache(directory: str):
+  os.makedirs(directory, exist_ok=True)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+def load_templates():
+  """Loads every template, so no request pays for it"""
+  for name in template_names():
+    app.jinja_env.get_template(name)
+
+@app.cli.command('compile-templates')
+@click.option('--directory', help='Defaults to TEMPLATE_CACHE_DIR.')
+def compile_templates_command(directory):
+  """Compiles every template into the bytecode cache."""
+  directory = directory or app.config['TEMPLATE_CACHE_DIR']
+  if not directory:
+    raise click.UsageError('Set TEMPLATE_CACHE_DIR or pass --directory')
+  use_template_cache(directory)
+  app.jinja_env.cache.clear()
+  load_templates()
+  click.echo(f'Compiled {len(template_names())} templates into {directory}')
+
+#----------------------------------------------------------------------------#
+# Assets.
+#----------------------------------------------------------------------------#
+
+# Bundle name -> fingerprinted file, written by build-assets
+asset_manifest = load_manifest(app.static_folder)
+# A fingerprinted name changes with the content, so browsers may keep it forever
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def asset_urls(bundle: str):
+  """The URLs to load a bundle from: its built file, or its sources"""
+  if bundle in asset_manifest:
+    return [url_for('static', filename=asset_manifest[bundle])]
+  return [url_for('static', filename=path) for path in BUNDLES[bundle]]
+
+app.jinja_env.globals['asset_urls'] = asset_urls
+
+@app.cli.command('build-assets')
+def build_assets_command():
+  """Bundles, minifies, fingerprints and compresses the layout assets."""
+  asset_manifest.clear()
+  asset_manifest.update(build_assets(app.static_folder))
+  for bundle, path in asset_manifest.items():
+    click.echo(f'{bundle} -> static/{path}')
+
+@app.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+  """Built bundles, precompressed when the client accepts it"""
+  directory = os.path.join(app.static_folder, DIST_DIR)
+  mimetype = mimetypes.guess_type(filename)[0]
+  for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+    if request.accept_encodings[encoding] and \
+        os.path.isfile(os.path.join(directory, filename + suffix)):
+      response = send_from_directory(directory, filename + suffix,
+        mimetype=mimetype)
+      response.headers['Content-Encoding'] = encoding
+      break
+  else:
+    response = send_from_directory(directory, filename, mimetype=mimetype)
+  response.headers['Cache-Control'] = IMMUTABLE
+  response.vary.add('Accept-Encoding')
+  return response
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
@@ -109,88 +1043,66 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@read_only
 def venues():
-  list_of_venues = Venue.query.distinct('city','state').all()
+  return cached_page('venues',
+    lambda: (render_template('pages/venues.html', areas=get_areas()), None))
+
+def get_areas():
+  """
+  Builds the city/state -> venues -> num_upcoming_shows tree from a single
+  query over the venue counters, so the number of round trips does not depend
+  on the number of venues or shows.
+  """
+  rows = db.session.query(
+      Venue.id, Venue.name, Venue.city, Venue.state,
+      Venue.upcoming_shows_count
+    ).order_by(Venue.state, Venue.city, Venue.id).all()
   data = []
-  for v in list_of_venues:
-        venues = Venue.query.filter(Venue.city == v.city, Venue.state == v.state).all()
-        org_venues = []
-        for venue in venues:
-          org_venues.append(get_formatted_info(venue.id, venue))
-        response = {
-          'state': v.state,
-          'city': v.city,
-          'venues': org_venues
-        }
-        data.append(response)
-  return render_template('pages/venues.html', areas=data);
-
-def get_formatted_info(id: int, venue: Venue):
+  for (city, state), venues in groupby(rows, key=lambda row: (row[2], row[3])):
+    data.append({
+      'city': city,
+      'state': state,
+      'venues': [{
+        'id': id,
+        'name': name,
+        'num_upcoming_shows': num_upcoming_shows
+      } for id, name, _, _, num_upcoming_shows in venues]
+    })
+  return data
+
+def get_formatted_info(entity):
+  """Search result entry for a Venue or an Artist"""
   response = {
-    'id': venue.id,
-    'name': venue.name,
-    'num_upcoming_shows': get_upcoming_shows(id, venue)
+    'id': entity.id,
+    'name': entity.name,
+    'num_upcoming_shows': entity.upcoming_shows_count
   }
   return response
 
-def get_upcoming_shows(id: int, venue:Venue):
-  shows = Show.query.filter_by(venue_id=id).all()
-  count = 0
-  for show in shows:
-    if show.start_time > datetime.now():
-          count += 1
-  return count
-  
-
 @app.route('/venues/search', methods=['POST'])
+@read_only
 def search_venues():
-  search_term = request.form.get('search_term', '')
-  search_term = '%'+search_term+'%'
-  search_result = Venue.query.filter(Venue.name.like(search_term)).all()
-  data = []
-  for venue in search_result:
-    data.append(get_formatted_info(venue.id, venue))
-  response ={
-    'count':len(search_result),
-    'data': data
-  }
-  return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
+  response, search_term = search_response(Venue)
+  return render_template('pages/search_venues.html', results=response, search_term=search_term)
 
-def get_formatted_info(id: int, artist: Artist):
-  response = {
-    'id': artist.id,
-    'name': artist.name,
-    'num_upcoming_shows': get_upcoming_shows(id, artist)
-  }
-  return response
-
-def get_upcoming_shows(id: int, artist: Artist):
-  shows = Show.query.filter_by(artist_id=id).all()
-  count = 0
-  for show in shows:
-    if show.start_time > datetime.now():
-      count += 1
-  return count
+@app.route('/venues/typeahead')
+@read_only
+def typeahead_venues():
+  return typeahead_response(Venue)
 
 @app.route('/venues/<int:venue_id>')
+@read_only
 def show_venue(venue_id):
-  venue = Venue.query.filter_by(id=venue_id).first()
+  return cached_page(f'venue:{venue_id}', lambda: render_venue(venue_id))
+
+def render_venue(venue_id):
+  venue = Venue.query.options(
+    db.selectinload(Venue.shows).joinedload(Show.Artist)
+  ).filter_by(id=venue_id).first()
   if venue is None:
-    return render_template('/errors/404.html')
-  past_shows = get_past_shows(venue.id, venue)
-  temp = []
-  past_show_count = 0
-  for show in past_shows:
-    if show['artist_id'] not in temp:
-      temp.append(show['artist_id'])
-      past_show_count += 1
-  upcoming_shows = get_upcoming_show_formated(venue.id, venue)
-  temp = []
-  upcoming_show_count = 0
-  for show in upcoming_shows:
-    if show['artist_id'] not in temp:
-      temp.append(show['artist_id'])
-      upcoming_show_count += 1
+    return render_template('/errors/404.html'), 0
+  past_shows, upcoming_shows = get_show_timeline(venue.shows, 'Artist')
   data = {
     "id": venue.id,
     "name": venue.name,
@@ -206,42 +1118,41 @@ def show_venue(venue_id):
     "image_link": venue.image_link,
     "past_shows": past_shows,
     "upcoming_shows": upcoming_shows,
-    "past_show_count": past_show_count,
-    "upcoming_shows_count": upcoming_show_count,
+    "past_shows_count": count_distinct(past_shows, 'artist_id'),
+    "upcoming_shows_count": count_distinct(upcoming_shows, 'artist_id'),
   }
-  return render_template('pages/show_venue.html', venue=data)
-
-def get_past_shows(id: int, venue: Venue):
-  shows = Show.query.filter_by(venue_id=id).all()
-  response = []
-  for show in shows:
-    print(datetime.now())
-    if show.start_time < datetime.now():
-      artist = Artist.query.filter_by(id=show.artist_id).first()
-      data = {
-      "artist_id": artist.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": format_datetime(str(show.start_time))
-      }
-      response.append(data)
-  return response
-  
-def get_upcoming_show_formated(id: int, venue: Venue):
-  shows = Show.query.filter_by(venue_id=id).all()
-  response = []
-  for show in shows:
-    print(datetime.now())
-    if show.start_time > datetime.now():
-      artist = Artist.query.filter_by(id=show.artist_id).first()
-      data = {
-      "artist_id": artist.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": format_datetime(str(show.start_time))
-      }
-      response.append(data)
-  return response
+  html = render_template('pages/show_venue.html', venue=data)
+  return html, timeline_timeout(venue.shows)
+
+def get_show_timeline(shows, counterpart: str):
+  """
+  Splits already loaded shows into past and upcoming ones around a single
+  cutoff. `counterpart` is the side of the show that is not the page owner,
+  either 'Artist' or 'Venue', and should be eagerly loaded by the caller.
+  """
+  now = datetime.now()
+  prefix = counterpart.lower()
+  past_shows = []
+  upcoming_shows = []
+  for show in sorted(shows, key=lambda show: show.start_time):
+    other = getattr(show, counterpart)
+    data = {
+      prefix + "_id": other.id,
+      prefix + "_name": other.name,
+      prefix + "_image_link": other.image_link,
+      "start_time": show.start_time
+    }
+    if show.start_time < now:
+      past_shows.append(data)
+    else:
+      upcoming_shows.append(data)
+  # Used to be a print() per show, now sampled, see LOG_DEBUG_SAMPLE_RATE
+  app.logger.debug('timeline at %s: %d past, %d upcoming shows', now,
+    len(past_shows), len(upcoming_shows))
+  return past_shows, upcoming_shows
+
+def count_distinct(shows, key: str):
+  return len({show[key] for show in shows})
 
 #  Create Venue
 #  ----------------------------------------------------------------
@@ -254,7 +1165,6 @@ def create_venue_form():
 @app.route('/venues/create', methods=['POST'])
 def create_venue_submission():
   try:
-    id = Venue.query.count()+1
     name = request.form['name']
     city = request.form['city']
     state = request.form['state']
@@ -262,9 +1172,13 @@ def create_venue_submission():
     phone = request.form['phone']
     genres = request.form.getlist('genres')
     facebook_link = request.form['facebook_link']
-    venue = Venue(id=id, name=name, city=city, state=state, address=address, phone=phone, genres=genres, facebook_link=facebook_link)
+    venue = Venue(name=name, city=city, state=state, address=address, phone=phone, genres=genres, facebook_link=facebook_link)
     db.session.add(venue)
+    db.session.flush()
+    index_for_search(venue)
+    update_facets(Venue, new=entity_facets(venue))
     db.session.commit()
+    page_cache.invalidate('venues')
     # on successful db insert, flash success
     flash('Venue ' + request.form['name'] + ' was successfully listed!')
   except:
@@ -277,8 +1191,13 @@ def create_venue_submission():
 @app.route('/venues/<venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
   try:
-    venue = Venue.query.filter_by(id=venue_id).delete()
+    venue = Venue.query.filter_by(id=venue_id).first()
+    if venue is not None:
+      update_facets(Venue, old=entity_facets(venue))
+    Venue.query.filter_by(id=venue_id).delete()
     db.session.commit()
+    unindex_for_search(Venue, int(venue_id))
+    invalidate_venue(venue_id)
     flash('Venue was successfully deleted!')
   except:
     db.session.rollback()
@@ -286,12 +1205,16 @@ def delete_venue(venue_id):
     flash('An error occurred. Venue ' + venue.name + ' could not be deleted.')
   finally:
     db.session.close()
-  return None
+  return '', 204
 
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@read_only
 def artists():
+  return cached_page('artists', lambda: (render_artists(), None))
+
+def render_artists():
   artists = Artist.query.all()
   data = []
   for artist in artists:
@@ -303,39 +1226,28 @@ def artists():
   return render_template('pages/artists.html', artists=data)
 
 @app.route('/artists/search', methods=['POST'])
+@read_only
 def search_artists():
-  response = {}
-  search_term = request.form.get('search_term', '')
-  search_term = '%'+search_term+'%'
-  search_result = Artist.query.filter(Artist.name.ilike(search_term)).all()
-  data = []
-  for artist in search_result:
-    data.append(get_formatted_info(artist.id, artist))
-  response ={
-    'count':len(search_result),
-    'data': data
-  }
-  return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
+  response, search_term = search_response(Artist)
+  return render_template('pages/search_artists.html', results=response, search_term=search_term)
+
+@app.route('/artists/typeahead')
+@read_only
+def typeahead_artists():
+  return typeahead_response(Artist)
 
 @app.route('/artists/<int:artist_id>')
+@read_only
 def show_artist(artist_id):
-  artist = Artist.query.filter_by(id=artist_id).first()
+  return cached_page(f'artist:{artist_id}', lambda: render_artist(artist_id))
+
+def render_artist(artist_id):
+  artist = Artist.query.options(
+    db.selectinload(Artist.shows).joinedload(Show.Venue)
+  ).filter_by(id=artist_id).first()
   if artist is None:
-    return render_template('/errors/404.html')
-  past_shows = get_past_shows_artist(artist_id, artist)
-  temp = []
-  past_show_count = 0
-  for show in past_shows:
-    if show['venue_id'] not in temp:
-      temp.append(show['venue_id'])
-      past_show_count += 1
-  upcoming_shows = get_upcoming_show_formated_artist(artist_id, artist)
-  temp = []
-  upcoming_show_count = 0
-  for show in upcoming_shows:
-    if show['venue_id'] not in temp:
-      temp.append(show['venue_id'])
-      upcoming_show_count += 1
+    return render_template('/errors/404.html'), 0
+  past_shows, upcoming_shows = get_show_timeline(artist.shows, 'Venue')
   data = {
     "id": artist.id,
     "name": artist.name,
@@ -349,55 +1261,20 @@ def show_artist(artist_id):
     "image_link": artist.image_link,
     "past_shows": past_shows,
     "upcoming_shows": upcoming_shows,
-    "past_shows_count": past_show_count,
-    "upcoming_shows_count": upcoming_show_count
+    "past_shows_count": count_distinct(past_shows, 'venue_id'),
+    "upcoming_shows_count": count_distinct(upcoming_shows, 'venue_id')
   }
-  return render_template('pages/show_artist.html', artist=data)
-
-def get_past_shows_artist(id: int, artist: Artist):
-  shows = Show.query.filter_by(artist_id=id).all()
-  response = []
-  for show in shows:
-    if show.start_time < datetime.now():
-      venue = Venue.query.filter_by(id=show.venue_id).first()
-      data = {
-      "venue_id": venue.id,
-      "venue_name": venue.name,
-      "venue_image_link": venue.image_link,
-      "start_time": format_datetime(str(show.start_time))
-      }
-      response.append(data)
-  return response
-  
-def get_upcoming_show_formated_artist(id: int, artist: Artist):
-  shows = Show.query.filter_by(artist_id=id).all()
-  response = []
-  for show in shows:
-    if show.start_time > datetime.now():
-      venue = Venue.query.filter_by(id=show.venue_id).first()
-      data = {
-      "venue_id": venue.id,
-      "venue_name": venue.name,
-      "venue_image_link": venue.image_link,
-      "start_time": format_datetime(str(show.start_time))
-      }
-      response.append(data)
-  return response
+  html = render_template('pages/show_artist.html', artist=data)
+  return html, timeline_timeout(artist.shows)
 
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
-  form = ArtistForm()
   artist = Artist.query.filter_by(id=artist_id).first()
   if artist is None:
     return render_template('errors/404.html')
-  form['name'].data = artist.name
-  form['genres'].data = artist.genres
-  form['city'].data = artist.city
-  form['state'].data = artist.state
-  form['phone'].data = artist.phone
-  form['facebook_link'].data = artist.facebook_link
+  form = ArtistForm(obj=artist)
   return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
@@ -405,6 +1282,7 @@ def edit_artist_submission(artist_id):
   error = False
   try:
     artist = Artist.query.filter_by(id=artist_id).first()
+    old_facets = entity_facets(artist)
     artist.name = request.form['name']
     artist.genres = request.form.getlist('genres')
     artist.city = request.form['city']
@@ -412,7 +1290,11 @@ def edit_artist_submission(artist_id):
     artist.phone = request.form['phone']
     artist.facebook_link = request.form['facebook_link']
     db.session.add(artist)
+    db.session.flush()
+    index_for_search(artist)
+    update_facets(Artist, old_facets, entity_facets(artist))
     db.session.commit()
+    invalidate_artist(artist_id)
     flash("Artist was edited!")
   except:
     error = True
@@ -425,17 +1307,10 @@ def edit_artist_submission(artist_id):
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
-  form = VenueForm()
   venue = Venue.query.filter_by(id=venue_id).first()
   if venue is None:
     return render_template('errors/404.html')
-  form['name'].data = venue.name
-  form['genres'].data = venue.genres
-  form['city'].data = venue.city
-  form['state'].data = venue.state
-  form['phone'].data = venue.phone
-  form['facebook_link'].data = venue.facebook_link
-  form['address'].data = venue.address
+  form = VenueForm(obj=venue)
   return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
@@ -443,6 +1318,7 @@ def edit_venue_submission(venue_id):
   error = False
   try:
     venue = Venue.query.filter_by(id=venue_id).first()
+    old_facets = entity_facets(venue)
     venue.name = request.form['name']
     venue.genres = request.form.getlist('genres')
     venue.city = request.form['city']
@@ -451,7 +1327,11 @@ def edit_venue_submission(venue_id):
     venue.phone = request.form['phone']
     venue.facebook_link = request.form['facebook_link']
     db.session.add(venue)
+    db.session.flush()
+    index_for_search(venue)
+    update_facets(Venue, old_facets, entity_facets(venue))
     db.session.commit()
+    invalidate_venue(venue_id)
     flash("Venue was edited!")
   except:
     error = True
@@ -474,16 +1354,19 @@ def create_artist_form():
 @app.route('/artists/create', methods=['POST'])
 def create_artist_submission():
   try:
-    id = Artist.query.count()+1
     name = request.form['name']
     city = request.form['city']
     state = request.form['state']
     phone = request.form['phone']
     genres = request.form.getlist('genres')
     facebook_link = request.form['facebook_link']
-    artist = Artist(id=id, name=name, city=city, state=state, address=address, phone=phone, genres=genres, facebook_link=facebook_link)
+    artist = Artist(name=name, city=city, state=state, phone=phone, genres=genres, facebook_link=facebook_link)
     db.session.add(artist)
+    db.session.flush()
+    index_for_search(artist)
+    update_facets(Artist, new=entity_facets(artist))
     db.session.commit()
+    page_cache.invalidate('artists')
     # on successful db insert, flash success
     flash('Artist ' + request.form['name'] + ' was successfully listed!')
   except:
@@ -497,24 +1380,108 @@ def create_artist_submission():
 #  Shows
 #  ----------------------------------------------------------------
 
+SHOWS_PER_PAGE = 30
+SHOWS_STREAM_BATCH = 1000
+
+def encode_cursor(start_time: datetime, id: int):
+  """Opaque token for the (start_time, id) keyset position of a show"""
+  value = f'{start_time.isoformat()}|{id}'
+  return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_cursor(cursor: str):
+  start_time, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+  return datetime.fromisoformat(start_time), int(id)
+
+def get_shows_page(after=None, limit=SHOWS_PER_PAGE):
+  """
+  Returns the shows ordered by (start_time, id) that come after the keyset
+  position `after`, together with their venue and artist in one query.
+  """
+  query = db.session.query(
+      Show.id, Show.start_time, Venue.id, Venue.name,
+      Artist.id, Artist.name, Artist.image_link
+    ).join(Venue, Venue.id == Show.venue_id) \
+    .join(Artist, Artist.id == Show.artist_id)
+  if after is not None:
+    query = query.filter(db.tuple_(Show.start_time, Show.id) > after)
+  return query.order_by(Show.start_time, Show.id).limit(limit).all()
+
+def format_show(row):
+  return {
+    "venue_id": row[2],
+    "venue_name": row[3],
+    "artist_id": row[4],
+    "artist_name": row[5],
+    "artist_image_link": row[6],
+    "start_time": row[1]
+  }
+
+def iter_shows(after=None):
+  """Walks every show page by page, so only one batch is held in memory"""
+  while True:
+    rows = get_shows_page(after, SHOWS_STREAM_BATCH)
+    for row in rows:
+      yield format_show(row)
+    if len(rows) < SHOWS_STREAM_BATCH:
+      return
+    after = (rows[-1][1], rows[-1][0])
+
+def get_shows_request():
+  """Reads the cursor and page size of a /shows request"""
+  cursor = request.args.get('after')
+  after = decode_cursor(cursor) if cursor else None
+  limit = min(request.args.get('limit', SHOWS_PER_PAGE, type=int), SHOWS_STREAM_BATCH)
+  # LIMIT -1 is no limit at all on SQLite
+  if limit < 1:
+    raise ValueError('limit must be positive')
+  return after, limit
+
 @app.route('/shows')
+@read_only
 def shows():
   # displays list of shows at /shows
+  try:
+    after, limit = get_shows_request()
+  except ValueError:
+    abort(400)
+  if request.args.get('stream'):
+    template = app.jinja_env.get_template('pages/shows.html')
+    context = {'shows': (dict(show, start_time=format_datetime(show['start_time'], 'full'))
+      for show in iter_shows(after)), 'next_cursor': None}
+    app.update_template_context(context)
+    return Response(stream_with_context(template.generate(context)))
+  rows = get_shows_page(after, limit)
+  start_times = format_datetimes([row[1] for row in rows], 'full')
   data = []
-  shows = Show.query.all()
-  for show in shows:
-    venue = Venue.query.filter_by(id=show.venue_id).first()
-    artist = Artist.query.filter_by(id=show.artist_id).first()
-    response = {
-      "venue_id": venue.id,
-      "venue_name": venue.name,
-      "artist_id": artist.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": format_datetime(str(show.start_time))
-    }
+  for row, start_time in zip(rows, start_times):
+    response = format_show(row)
+    response['start_time'] = start_time
     data.append(response)
-  return render_template('pages/shows.html', shows=data)
+  next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+  return render_template('pages/shows.html', shows=data, next_cursor=next_cursor)
+
+@app.route('/shows.json')
+@read_only
+def shows_json():
+  try:
+    after, limit = get_shows_request()
+  except ValueError:
+    abort(400)
+  if request.args.get('stream'):
+    # One JSON document per line, see http://ndjson.org
+    lines = (json.dumps(dict(show, start_time=show['start_time'].isoformat())) + '\n'
+      for show in iter_shows(after))
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+  rows = get_shows_page(after, limit)
+  data = []
+  for row in rows:
+    response = format_show(row)
+    response['start_time'] = row[1].isoformat()
+    data.append(response)
+  return jsonify({
+    'shows': data,
+    'next_cursor': encode_cursor(rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+  })
 
 @app.route('/shows/create')
 def create_shows():
@@ -524,33 +1491,38 @@ def create_shows():
 
 @app.route('/shows/create', methods=['POST'])
 def create_show_submission():
-  artist_id = request.form['artist_id']
-  start_time = request.form['start_time']
-  artist = Artist.query.filter_by(id=artist_id).first()
-  artist_availability = []
-  if artist.availability is not None: artist_availability = artist.availability
-  for availability in artist_availability:
-    if start_time == availability:
-      try:
-        id = Show.query.count()+1
-        venue_id = request.form['venue_id']
-        venue = Venue.query.filter_by(id=venue_id).first()
-        if venue is not None and artist is not None:
-          flash("Invalid Reservation Try!")
-          return render_template('pages/home.html')
-        show = Show(id=id, venue_id=venue_id, artist_id=artist_id, start_time=start_time)
-        db.session.add(show)
-        db.session.commit()
-        # on successful db insert, flash success
-        flash('Show was successfully listed!')
-      except:
-        flash('An error occurred. Show could not be listed.')
+  try:
+    artist_id = int(request.form['artist_id'])
+    venue_id = int(request.form['venue_id'])
+    start_time = parse_request_time(request.form['start_time'])
+  except (KeyError, ValueError, OverflowError):
+    flash("Invalid Reservation Try!")
+    return render_template('pages/home.html')
+  if Artist.query.get(artist_id) is None or Venue.query.get(venue_id) is None:
+    flash("Invalid Reservation Try!")
+    return render_template('pages/home.html')
+  # The check and the insert are one transaction, under the booking locks
+  with booking_lock:
+    try:
+      lock_bookings([artist_id], [venue_id])
+      conflicts = booking_conflicts(artist_id, venue_id, start_time)
+      if conflicts:
         db.session.rollback()
-      finally:
-        db.session.close()
+        flash(conflicts[0])
         return render_template('pages/home.html')
-  # If not available at that time then
-  flash("Artist not available at that time")
+      show = Show(venue_id=venue_id, artist_id=artist_id, start_time=start_time)
+      db.session.add(show)
+      count_show(show)
+      db.session.commit()
+      # /venues lists the upcoming show counters
+      page_cache.invalidate('venues', f'venue:{venue_id}', f'artist:{artist_id}')
+      # on successful db insert, flash success
+      flash('Show was successfully listed!')
+    except:
+      flash('An error occurred. Show could not be listed.')
+      db.session.rollback()
+    finally:
+      db.session.close()
   return render_template('pages/home.html')
 
 @app.errorhandler(404)
@@ -562,15 +1534,24 @@ def server_error(error):
     return render_template('errors/500.html'), 500
 
 
-if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('errors')
+# Templates are still loaded on first use, only from the cache
+if app.config['TEMPLATE_CACHE_DIR']:
+    use_template_cache(app.config['TEMPLATE_CACHE_DIR'])
+
+# The writer thread and LOG_FILE wait for the first request, so importing
+# the app for tests or CLI commands starts neither
+log_writer = None
+log_writer_lock = threading.Lock()
+
+@app.before_request
+def start_logging():
+  global log_writer
+  if log_writer is not None or app.debug or app.testing:
+    return
+  with log_writer_lock:
+    if log_writer is None:
+      log_writer = setup_logging(app)
+      app.logger.info('errors')
 
 #----------------------------------------------------------------------------#
 # Launch.
@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # .br files are only written when brotli is installed
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:  # unminified scripts are then bundled as they are
+    rjsmin = None
+
+# Bundles are written to static/dist, one level below static like css/ and
+# js/, so relative url()s such as ../fonts/... keep pointing at the same files.
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+# Bundle name -> files under static/, in load order. These are the assets of
+# layouts/main.html.
+BUNDLES = {
+    'main.css': [
+        'css/bootstrap.min.css',
+        'css/layout.main.css',
+        'css/main.css',
+        'css/main.responsive.css',
+        'css/main.quickfix.css',
+    ],
+    # Loaded in <head> before the page renders
+    'head.js': [
+        'js/libs/modernizr-2.8.2.min.js',
+        'js/libs/moment.min.js',
+    ],
+    # Loaded with defer, so they run in this order after jQuery
+    'deferred.js': [
+        'js/script.js',
+        'js/libs/bootstrap-3.1.1.min.js',
+        'js/plugins.js',
+    ],
+}
+# Compressed copies smaller than this are not worth the extra file
+MIN_COMPRESS_SIZE = 1024
+
+CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*.*?\*/)',
+                        re.S)
+SOURCE_MAP = re.compile(r'^//[#@] sourceMappingURL=.*$', re.M)
+
+
+def minify_css(text):
+    """
+    Drops comments, except /*! license */ ones, and the whitespace around
+    punctuation. Strings are copied untouched.
+    """
+    parts = []
+    # Text up to the next string or kept comment, dropped comments count as
+    # whitespace
+    pending = []
+    position = 0
+    for match in CSS_TOKENS.finditer(text):
+        pending.append(text[position:match.start()])
+        position = match.end()
+        string, comment = match.groups()
+        if string:
+            parts.append(squeeze_css(''.join(pending)))
+            parts.append(string)
+        elif comment.startswith('/*!'):
+            # License comments sit between rules, where spaces mean nothing
+            parts.append(squeeze_css(''.join(pending)).strip())
+            parts.append(comment)
+        else:
+            pending.append(' ')
+            continue
+        pending = []
+    pending.append(text[position:])
+    parts.append(squeeze_css(''.join(pending)))
+    return ''.join(parts).strip()
+
+
+def squeeze_css(text):
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r' ?([{};,>]) ?', r'\1', text)
+    text = re.sub(r': ', ':', text)
+    return text.replace(';}', '}')
+
+
+def minify_js(name, text):
+    text = SOURCE_MAP.sub('', text)
+    if rjsmin is None or name.endswith('.min.js'):
+        return text.strip()
+    return rjsmin.jsmin(text)
+
+
+def build_bundle(static_dir, name):
+    """Returns the minified content of the bundle `name`"""
+    parts = []
+    for path in BUNDLES[name]:
+        with open(os.path.join(static_dir, path), encoding='utf-8') as source:
+            text = source.read()
+        if name.endswith('.css'):
+            parts.append(minify_css(text))
+        else:
+            parts.append(minify_js(path, text))
+    # A script without a trailing semicolon must not run into the next one
+    separator = '\n' if name.endswith('.css') else '\n;\n'
+    return separator.join(parts).encode('utf-8')
+
+
+def fingerprint(name, content):
+    """main.css -> main.0123456789ab.css, after a digest of the content"""
+    stem, extension = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return '%s.%s%s' % (stem, digest, extension)
+
+
+def write_compressed(path, content):
+    if len(content) < MIN_COMPRESS_SIZE:
+        return
+    with open(path + '.gz', 'wb') as target:
+        target.write(gzip.compress(content, 9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as target:
+            target.write(brotli.compress(content))
+
+
+def build_assets(static_dir):
+    """
+    Builds every bundle into static/dist with a fingerprinted name, next to
+    its gzip and brotli copies, and writes the manifest that maps bundle
+    names to files. Files of previous builds are removed.
+    """
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+    for name in BUNDLES:
+        content = build_bundle(static_dir, name)
+        filename = fingerprint(name, content)
+        path = os.path.join(dist_dir, filename)
+        with open(path, 'wb') as target:
+            target.write(content)
+        write_compressed(path, content)
+        manifest[name] = DIST_DIR + '/' + filename
+    keep = {os.path.basename(path) for path in manifest.values()}
+    for filename in os.listdir(dist_dir):
+        if filename != MANIFEST and \
+                re.sub(r'\.(gz|br)$', '', filename) not in keep:
+            os.remove(os.path.join(dist_dir, filename))
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as target:
+        json.dump(manifest, target, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir):
+    """The manifest of the last build, empty when the assets were not built"""
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST)) as source:
+            return json.load(source)
+    except FileNotFoundError:
+        return {}
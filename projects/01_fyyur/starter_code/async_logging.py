@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+# Records waiting for the writer thread. When it falls this far behind new
+# records are dropped (and counted) rather than blocking the request.
+QUEUE_SIZE = 10000
+# Records written per write + flush
+BATCH_SIZE = 500
+# Seconds the writer lets records pile up before writing a batch, so a busy
+# app does not wake it up, and contend for the GIL, once per record
+FLUSH_INTERVAL = 0.05
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'where': '%s:%d' % (record.pathname, record.lineno)
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class SampledDebugFilter(logging.Filter):
+    """Lets through every record above DEBUG but only `rate` of the DEBUG ones"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Never blocks the caller, records that do not fit are counted instead"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer thread formats, here only the arguments are merged so the
+        # record no longer references request objects
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that writes a list of records with one flush"""
+
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            for record in records:
+                if self.shouldRollover(record):
+                    self.doRollover()
+                # Rolling over with delay=True leaves the file closed
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(self.format(record) + self.terminator)
+            self.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class AsyncLogWriter:
+    """
+    Moves log file I/O off the request thread: loggers get `queue_handler`,
+    which only enqueues, and a daemon thread drains the queue in batches
+    into `handler`.
+    """
+
+    stop_record = object()
+
+    def __init__(self, handler, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-writer',
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if batch[0] is not self.stop_record:
+                time.sleep(self.flush_interval)
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.stop_record in batch:
+                stopping = True
+                batch = [record for record in batch
+                         if record is not self.stop_record]
+            if batch:
+                self.handler.emit_batch(batch)
+
+    def stop(self):
+        """Writes out what is queued and ends the thread"""
+        if self.thread is None:
+            return
+        self.queue.put(self.stop_record)
+        self.thread.join()
+        self.thread = None
+        self.handler.close()
+
+
+def setup_logging(app):
+    """
+    Sends the app logger to LOG_FILE as rotated JSON lines through an
+    AsyncLogWriter. Returns the writer, already started.
+    """
+    config = app.config
+    handler = BatchFileHandler(config.get('LOG_FILE', 'error.log'),
+                               maxBytes=config.get('LOG_MAX_BYTES', MAX_BYTES),
+                               backupCount=config.get('LOG_BACKUP_COUNT',
+                                                      BACKUP_COUNT),
+                               delay=True)
+    handler.setFormatter(JSONFormatter())
+    writer = AsyncLogWriter(handler)
+    writer.queue_handler.addFilter(
+        SampledDebugFilter(config.get('LOG_DEBUG_SAMPLE_RATE', 0.01)))
+    app.logger.setLevel(config.get('LOG_LEVEL', 'INFO'))
+    app.logger.addHandler(writer.queue_handler)
+    writer.start()
+    return writer
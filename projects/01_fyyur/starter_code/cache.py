@@ -0,0 +1,122 @@
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed for CACHE_TYPE = 'redis'
+    redis = None
+
+
+class LRUCache:
+    """In-process cache that evicts the least recently used entry"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache:
+    """Cache stored in Redis, or any server speaking its protocol"""
+
+    def __init__(self, url, prefix='fyyur:'):
+        if redis is None:
+            raise RuntimeError('CACHE_TYPE redis needs the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.prefix + key, value,
+                        ex=None if timeout is None else max(int(timeout), 1))
+
+    def delete_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class PageCache:
+    """Counts hits and misses in front of one of the backends above"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+
+    def invalidate(self, *keys):
+        self.invalidations += len(keys)
+        self.backend.delete_many(keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else None
+        }
+
+
+def create_cache(config):
+    """Builds the page cache described by CACHE_TYPE in the app config"""
+    cache_type = config.get('CACHE_TYPE', 'lru')
+    if cache_type == 'redis':
+        return PageCache(RedisCache(config['CACHE_REDIS_URL']))
+    if cache_type == 'lru':
+        return PageCache(LRUCache(config.get('CACHE_MAX_ENTRIES', 1024)))
+    raise ValueError('Unknown CACHE_TYPE ' + cache_type)
@@ -1,5 +1,8 @@
 import os
-SECRET_KEY = os.urandom(32)
+from datetime import timedelta
+# Signs the session. Set SECRET_KEY when running several workers, each
+# one draws its own random key otherwise and drops the others' sessions.
+SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -10,5 +13,63 @@ DEBUG = True
 
 
 # TODO IMPLEMENT DATABASE URL
-SQLALCHEMY_DATABASE_URI = 'postgres://postgres:1@localhost:5432/fyyur'
-SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'DATABASE_URL', 'postgres://postgres:1@localhost:5432/fyyur')
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Connection pool. Pre-ping replaces connections the server has closed and
+# recycling keeps them younger than most server or proxy idle timeouts.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+}
+# SQLite files are not pooled, so only servers get a sized pool
+if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    SQLALCHEMY_ENGINE_OPTIONS.update({
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+    })
+
+# Read replicas, comma separated. The read-only views query one of them,
+# everything else the primary above. Each replica is a bind named replica_N.
+SQLALCHEMY_BINDS = {
+    'replica_%d' % i: url for i, url in enumerate(
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url)
+}
+# A client that just wrote reads from the primary for this long, so it
+# sees its own changes despite replication lag.
+REPLICA_STICKY_SECONDS = 5
+# That stickiness lives in the session, every worker has to share the key
+if SQLALCHEMY_BINDS and not os.environ.get('SECRET_KEY'):
+    raise RuntimeError('DATABASE_REPLICA_URLS requires SECRET_KEY to be set')
+
+# Per request query counts and database time in Server-Timing headers and
+# the log, with repeated statements flagged as N+1 patterns
+SQL_PROFILER = bool(os.environ.get('SQL_PROFILER'))
+
+# Outside debug mode the app logs JSON lines to LOG_FILE from a background
+# thread, rotating at LOG_MAX_BYTES. With LOG_LEVEL DEBUG only a sample of
+# the debug records is kept.
+LOG_FILE = os.environ.get('LOG_FILE', 'error.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+
+# Directory of the Jinja bytecode cache shared by the workers, filled with
+# `flask compile-templates`. Unset, every worker compiles its templates.
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+
+# Page cache: 'lru' keeps pages in process, 'redis' shares them between
+# workers through any Redis compatible server at CACHE_REDIS_URL. Only
+# redis sees the invalidations of CLI commands such as roll-show-counters,
+# lru pages then stay stale until CACHE_DEFAULT_TIMEOUT.
+CACHE_TYPE = os.environ.get('CACHE_TYPE', 'lru')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_MAX_ENTRIES = 1024
+CACHE_DEFAULT_TIMEOUT = 300
+
+# How long a show occupies its venue and artist, used for booking conflicts
+SHOW_DURATION = timedelta(hours=3)
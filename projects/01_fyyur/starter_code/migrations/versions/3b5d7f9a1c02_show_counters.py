@@ -0,0 +1,31 @@
+"""upcoming and past show counters on venues and artists
+
+Revision ID: 3b5d7f9a1c02
+Revises: 4a1c2e6f8b10
+Create Date: 2026-10-18 09:02:00.000000
+
+After upgrading run `flask roll-show-counters --all` to backfill the
+counters.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3b5d7f9a1c02'
+down_revision = '4a1c2e6f8b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Venue', 'Artist'):
+        op.add_column(table, sa.Column('upcoming_shows_count', sa.Integer(),
+                                       server_default='0', nullable=False))
+        op.add_column(table, sa.Column('past_shows_count', sa.Integer(),
+                                       server_default='0', nullable=False))
+
+
+def downgrade():
+    for table in ('Artist', 'Venue'):
+        op.drop_column(table, 'past_shows_count')
+        op.drop_column(table, 'upcoming_shows_count')
@@ -0,0 +1,40 @@
+"""weighted full text search vectors on venues and artists
+
+Revision ID: 5c7e9a1b3d04
+Revises: 3b5d7f9a1c02
+Create Date: 2026-10-18 09:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5c7e9a1b3d04'
+down_revision = '3b5d7f9a1c02'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = """
+    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', concat_ws(' ', city, state)), 'B') ||
+    setweight(to_tsvector('simple',
+        coalesce(array_to_string(genres, ' '), '')), 'C')
+"""
+
+
+def upgrade():
+    for table in ('Venue', 'Artist'):
+        op.add_column(table, sa.Column('search_vector', postgresql.TSVECTOR(),
+                                       nullable=True))
+        op.execute('UPDATE "{}" SET search_vector = {}'.format(
+            table, SEARCH_VECTOR))
+        op.create_index('ix_{}_search_vector'.format(table.lower()), table,
+                        ['search_vector'], postgresql_using='gin')
+
+
+def downgrade():
+    for table in ('Artist', 'Venue'):
+        op.drop_index('ix_{}_search_vector'.format(table.lower()),
+                      table_name=table)
+        op.drop_column(table, 'search_vector')
@@ -0,0 +1,42 @@
+"""availability slots and booking indexes
+
+Revision ID: 7d3b5f9a1c24
+Revises: 5c7e9a1b3d04
+Create Date: 2026-10-18 09:10:00.000000
+
+After upgrading run `flask migrate-availability` to copy
+Artist.availability.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '7d3b5f9a1c24'
+down_revision = '5c7e9a1b3d04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Availability',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('end_time', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_availability_artist_id_start_time', 'Availability',
+                    ['artist_id', 'start_time'])
+    op.create_index('ix_show_venue_id_start_time', 'Show',
+                    ['venue_id', 'start_time'])
+    op.create_index('ix_show_artist_id_start_time', 'Show',
+                    ['artist_id', 'start_time'])
+
+
+def downgrade():
+    op.drop_index('ix_show_artist_id_start_time', table_name='Show')
+    op.drop_index('ix_show_venue_id_start_time', table_name='Show')
+    op.drop_index('ix_availability_artist_id_start_time',
+                  table_name='Availability')
+    op.drop_table('Availability')
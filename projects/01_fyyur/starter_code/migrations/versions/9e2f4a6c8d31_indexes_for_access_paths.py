@@ -0,0 +1,39 @@
+"""indexes for the listing, search and keyset access paths
+
+Revision ID: 9e2f4a6c8d31
+Revises: 7d3b5f9a1c24
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9e2f4a6c8d31'
+down_revision = '7d3b5f9a1c24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /venues groups by area
+    op.create_index('ix_venue_state_city', 'Venue', ['state', 'city'])
+    # empty searches and listings order by name
+    op.create_index('ix_venue_name', 'Venue', ['name'])
+    op.create_index('ix_artist_name', 'Artist', ['name'])
+    # genre filters (genres @> ARRAY[...])
+    op.create_index('ix_venue_genres', 'Venue', ['genres'],
+                    postgresql_using='gin')
+    op.create_index('ix_artist_genres', 'Artist', ['genres'],
+                    postgresql_using='gin')
+    # /shows keyset pagination on (start_time, id)
+    op.create_index('ix_show_start_time_id', 'Show', ['start_time', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_show_start_time_id', table_name='Show')
+    op.drop_index('ix_artist_genres', table_name='Artist')
+    op.drop_index('ix_venue_genres', table_name='Venue')
+    op.drop_index('ix_artist_name', table_name='Artist')
+    op.drop_index('ix_venue_name', table_name='Venue')
+    op.drop_index('ix_venue_state_city', table_name='Venue')
@@ -0,0 +1,47 @@
+"""facet counts for browsing by genre, state and city
+
+Revision ID: b2c4d6e8f013
+Revises: 9e2f4a6c8d31
+Create Date: 2026-10-18 09:30:00.000000
+
+The counts are backfilled here on Postgres, elsewhere run
+`flask rebuild-facets` after upgrading.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b2c4d6e8f013'
+down_revision = '9e2f4a6c8d31'
+branch_labels = None
+depends_on = None
+
+BACKFILL = """
+    INSERT INTO "FacetCount" (kind, facet, value, count)
+    SELECT '{table}', 'genre', genre, count(*)
+      FROM (SELECT DISTINCT id, unnest(genres) AS genre FROM "{table}") g
+     WHERE genre <> '' GROUP BY genre
+    UNION ALL
+    SELECT '{table}', 'state', state, count(*) FROM "{table}"
+     WHERE state <> '' GROUP BY state
+    UNION ALL
+    SELECT '{table}', 'city', city, count(*) FROM "{table}"
+     WHERE city <> '' GROUP BY city
+"""
+
+
+def upgrade():
+    op.create_table('FacetCount',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('facet', sa.String(length=20), nullable=False),
+    sa.Column('value', sa.String(length=120), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'facet', 'value')
+    )
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in ('Venue', 'Artist'):
+            op.execute(BACKFILL.format(table=table))
+
+
+def downgrade():
+    op.drop_table('FacetCount')
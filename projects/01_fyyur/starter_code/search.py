@@ -0,0 +1,125 @@
+import re
+from bisect import bisect_left
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Splits text into lower case word tokens"""
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    In-process inverted index used for search when the database has no
+    full-text support (the SQLite test runs). Documents are added as a dict
+    of field name -> text and every field carries a weight, so a match in the
+    name ranks above a match in the city or the genres.
+
+    Every query token is treated as a prefix, which is what type-ahead needs,
+    but exact token matches score higher than prefix matches.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+        self.vocabulary_dirty = False
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, fields):
+        """Adds or replaces the document `doc_id`"""
+        self.remove(doc_id)
+        scores = {}
+        for field, text in fields.items():
+            weight = self.weights.get(field, 1)
+            for token in tokenize(text):
+                scores[token] = max(scores.get(token, 0), weight)
+        for token, weight in scores.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                self.vocabulary_dirty = True
+            posting[doc_id] = weight
+        self.documents[doc_id] = list(scores)
+
+    def remove(self, doc_id):
+        for token in self.documents.pop(doc_id, []):
+            posting = self.postings[token]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[token]
+                self.vocabulary_dirty = True
+
+    def expand(self, prefix):
+        """Yields the (token, posting) pairs whose token starts with prefix"""
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_dirty = False
+        position = bisect_left(self.vocabulary, prefix)
+        while position < len(self.vocabulary):
+            token = self.vocabulary[position]
+            if not token.startswith(prefix):
+                break
+            yield token, self.postings[token]
+            position += 1
+
+    def match(self, token, postings, candidates=None):
+        """
+        Scores the documents found in `postings`, the expansion of `token`.
+        Exact token matches score their full weight, prefix matches half of
+        it. With `candidates` only those documents are looked up, which is
+        cheaper when the candidate set is small and the postings are large.
+        """
+        scores = {}
+        if candidates is None:
+            for candidate, posting in postings:
+                exact = candidate == token
+                for doc_id, weight in posting.items():
+                    score = weight if exact else weight / 2
+                    if score > scores.get(doc_id, 0):
+                        scores[doc_id] = score
+            return scores
+        for doc_id in candidates:
+            for candidate, posting in postings:
+                weight = posting.get(doc_id)
+                if weight is None:
+                    continue
+                score = weight if candidate == token else weight / 2
+                if score > scores.get(doc_id, 0):
+                    scores[doc_id] = score
+        return scores
+
+    def search(self, text, offset=0, limit=None):
+        """
+        Returns (total, doc_ids) for the documents matching every token in
+        `text`, ordered by relevance and then by id.
+        """
+        expansions = []
+        for token in set(tokenize(text)):
+            postings = list(self.expand(token))
+            size = sum(len(posting) for _, posting in postings)
+            expansions.append((size, token, postings))
+        if not expansions:
+            return 0, []
+        # Start from the rarest token so the candidate set stays small
+        expansions.sort(key=lambda expansion: expansion[0])
+        _, token, postings = expansions[0]
+        scores = self.match(token, postings)
+        for size, token, postings in expansions[1:]:
+            if not scores:
+                break
+            if len(scores) * len(postings) < size:
+                other = self.match(token, postings, scores)
+            else:
+                other = self.match(token, postings)
+            scores = {doc_id: score + other[doc_id]
+                      for doc_id, score in scores.items() if doc_id in other}
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+        end = None if limit is None else offset + limit
+        return len(ranked), ranked[offset:end]
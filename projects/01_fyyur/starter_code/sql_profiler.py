@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# A statement repeated this many times in one request is reported as a
+# likely N+1 pattern, a query issued once per row of a previous result.
+REPEAT_THRESHOLD = 5
+# Statements are shortened to this many characters in the logs
+STATEMENT_LENGTH = 200
+
+listening = False
+listening_lock = threading.Lock()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if has_request_context() and 'sql_profile' in g:
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+
+def record(conn, statement):
+    starts = conn.info.get('profile_start')
+    if not starts or not has_request_context() or 'sql_profile' not in g:
+        return
+    profile = g.sql_profile
+    profile['count'] += 1
+    profile['time'] += time.perf_counter() - starts.pop()
+    profile['statements'][statement] += 1
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    record(conn, statement)
+
+
+def handle_error(context):
+    """A failed statement gets no after_cursor_execute, its start is popped"""
+    if context.connection is not None and context.statement is not None:
+        record(context.connection, context.statement)
+
+
+def listen():
+    """Hooks every engine, once, the first time profiling is switched on"""
+    global listening
+    with listening_lock:
+        if not listening:
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+            listening = True
+
+
+class SQLProfiler:
+    """
+    Opt-in per request SQL statistics for a Flask app using SQLAlchemy.
+    With the SQL_PROFILER config key (or environment variable) set, every
+    request counts its statements, failed ones too, and database time,
+    reports them in a Server-Timing header and logs one JSON line at info
+    level, at warning level when a statement was repeated often enough to
+    look like an N+1 pattern. Set at init_app(), it also lowers the app
+    logger to info level when needed.
+
+    Streamed responses are measured up to the point the headers are sent.
+    """
+
+    def __init__(self, app=None, repeat_threshold=REPEAT_THRESHOLD):
+        self.repeat_threshold = repeat_threshold
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_PROFILER', bool(
+            os.environ.get('SQL_PROFILER')))
+        # The request summaries are logged at info level
+        if app.config['SQL_PROFILER'] and \
+                not app.logger.isEnabledFor(logging.INFO):
+            app.logger.setLevel(logging.INFO)
+        app.extensions['sql_profiler'] = self
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.pop('sql_profile', None)
+        if not current_app.config['SQL_PROFILER']:
+            return
+        listen()
+        g.sql_profile = {'count': 0, 'time': 0.0, 'statements': Counter()}
+
+    def repeated(self, profile):
+        return [{'statement': statement[:STATEMENT_LENGTH], 'count': count}
+                for statement, count in profile['statements'].most_common()
+                if count >= self.repeat_threshold]
+
+    def finish(self, response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+        timing = 'db;dur=%.1f;desc="%d queries"' % (profile['time'] * 1000,
+                                                    profile['count'])
+        if response.headers.get('Server-Timing'):
+            timing = response.headers['Server-Timing'] + ', ' + timing
+        response.headers['Server-Timing'] = timing
+        record = {
+            'event': 'sql_profile',
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': profile['count'],
+            'db_ms': round(profile['time'] * 1000, 1),
+            'repeated': self.repeated(profile)
+        }
+        log = current_app.logger.warning if record['repeated'] \
+            else current_app.logger.info
+        log(json.dumps(record))
+        return response
@@ -0,0 +1,1065 @@
+import json
+import logging
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# The tests run against a throwaway SQLite file unless told otherwise. A file
+# rather than :memory: gives every thread its own connection.
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'fyyur_test.db'))
+
+from flask import Flask
+from sqlalchemy import create_engine, event
+
+import app as fyyur
+from app import app, db, Venue, Artist, Show, get_areas, \
+    get_show_timeline, count_show, refresh_show_counters, roll_show_counters, \
+    search_entities, search_indexes, format_datetime, format_datetimes, \
+    page_cache, allocate_ids, bulk_insert, run_import, add_availability, \
+    booking_conflicts, check_schedule, Availability, get_facets, \
+    rebuild_facets, template_names, asset_manifest
+from assets import BUNDLES, build_assets, minify_css
+from bulk_import import TARGET_ROWS_PER_SECOND, URLRule, RowField
+from cache import LRUCache
+from forms import VenueForm, ArtistForm
+from wtforms.widgets import Select
+from wtforms.validators import URL, ValidationError
+from search import InvertedIndex
+from sql_profiler import SQLProfiler
+from async_logging import setup_logging
+
+# Benchmarks are slow, so they only run when FYYUR_BENCHMARK is set
+BENCHMARK = bool(os.environ.get('FYYUR_BENCHMARK'))
+
+
+class QueryCounter:
+    """Counts the SQL statements sent to the engine inside a `with` block"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def callback(self, connection, cursor, statement, parameters, *args):
+        self.count += 1
+        self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.callback)
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the fyyur test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        app.config['TESTING'] = True
+        self.client = app.test_client
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+        db.drop_all()
+        search_indexes.clear()
+        page_cache.clear()
+        self.ctx.pop()
+
+    def seed(self, venues, shows_per_venue=2):
+        """Adds `venues` venues spread over a few cities, each with shows"""
+        artist = Artist(name='Artist', city='Austin', state='TX',
+                        genres=['Jazz'])
+        db.session.add(artist)
+        db.session.flush()
+        for i in range(venues):
+            venue = Venue(name='Venue %d' % i, city='City %d' % (i % 5),
+                          state='TX', genres=['Jazz'])
+            db.session.add(venue)
+            db.session.flush()
+            for j in range(shows_per_venue):
+                offset = timedelta(days=j + 1)
+                start_time = datetime.now() + (offset if j % 2 else -offset)
+                db.session.add(Show(venue_id=venue.id, artist_id=artist.id,
+                                    start_time=start_time))
+        db.session.flush()
+        refresh_show_counters()
+        db.session.commit()
+
+    def count_queries(self, url):
+        page_cache.clear()
+        with QueryCounter(db.engine) as counter:
+            res = self.client().get(url)
+        self.assertEqual(res.status_code, 200)
+        return counter.count
+
+    def full_scans(self, statements):
+        """Runs EXPLAIN on every SELECT and returns the sequential scans"""
+        scans = []
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            postgres = db.engine.dialect.name == 'postgresql'
+            if postgres:
+                # Tiny test tables are cheaper to scan, only fail when the
+                # planner has no index to use at all
+                cursor.execute('SET enable_seqscan = off')
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                if postgres:
+                    cursor.execute('EXPLAIN ' + statement, parameters)
+                    scans += [row[0] for row in cursor.fetchall()
+                              if 'Seq Scan' in row[0]]
+                else:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + statement,
+                                   parameters)
+                    scans += [row[-1] for row in cursor.fetchall()
+                              if re.match(r'SCAN \S+$', row[-1])]
+        finally:
+            connection.close()
+        return scans
+
+    def test_hot_views_use_indexes(self):
+        self.seed(20, shows_per_venue=4)
+        add_availability(1, datetime(2099, 1, 1), datetime(2099, 1, 2))
+        db.session.commit()
+        page = self.client().get('/shows.json?limit=5').get_json()
+        page_cache.clear()
+        with QueryCounter(db.engine) as counter:
+            self.client().get('/shows?after=' + page['next_cursor'])
+            self.client().get('/shows')
+            self.client().get('/venues/3')
+            self.client().get('/artists/1')
+            self.client().post('/shows/check', json=[
+                {'artist_id': 1, 'venue_id': 2,
+                 'start_time': '2099-01-01 10:00'}])
+            booking_conflicts(1, 2, datetime(2099, 1, 1, 10))
+
+        self.assertEqual(self.full_scans(counter.statements), [])
+
+    def test_venues_areas(self):
+        self.seed(10)
+        areas = get_areas()
+
+        self.assertEqual(len(areas), 5)
+        self.assertEqual(sum(len(area['venues']) for area in areas), 10)
+        for area in areas:
+            for venue in area['venues']:
+                self.assertEqual(venue['num_upcoming_shows'], 1)
+
+    def test_venues_query_count_is_constant(self):
+        self.seed(5)
+        small = self.count_queries('/venues')
+        self.seed(200)
+        large = self.count_queries('/venues')
+
+        self.assertEqual(small, large)
+
+    def test_detail_pages_query_count_is_constant(self):
+        self.seed(1, shows_per_venue=2)
+        small_venue = self.count_queries('/venues/1')
+        small_artist = self.count_queries('/artists/1')
+        self.seed(1, shows_per_venue=500)
+        large_venue = self.count_queries('/venues/1')
+        large_artist = self.count_queries('/artists/1')
+
+        self.assertEqual(small_venue, large_venue)
+        self.assertEqual(small_artist, large_artist)
+
+    def test_show_venue_timeline(self):
+        self.seed(1, shows_per_venue=4)
+        venue = Venue.query.get(1)
+        past_shows, upcoming_shows = get_show_timeline(venue.shows, 'Artist')
+
+        self.assertEqual(len(past_shows), 2)
+        self.assertEqual(len(upcoming_shows), 2)
+        self.assertEqual(upcoming_shows[0]['artist_name'], 'Artist')
+
+    def test_count_show(self):
+        self.seed(1, shows_per_venue=0)
+        show = Show(venue_id=1, artist_id=1,
+                    start_time=datetime.now() + timedelta(days=1))
+        db.session.add(show)
+        count_show(show)
+        db.session.commit()
+        venue = Venue.query.get(1)
+        artist = Artist.query.get(1)
+
+        self.assertEqual(venue.upcoming_shows_count, 1)
+        self.assertEqual(artist.upcoming_shows_count, 1)
+        self.assertEqual(venue.past_shows_count, 0)
+
+    def test_roll_show_counters(self):
+        self.seed(2, shows_per_venue=0)
+        since = datetime.now() - timedelta(hours=1)
+        show = Show(venue_id=1, artist_id=1,
+                    start_time=datetime.now() + timedelta(seconds=1))
+        db.session.add(show)
+        count_show(show)
+        db.session.commit()
+        # Pretend the clock moved past the show
+        show.start_time = datetime.now() - timedelta(minutes=1)
+        db.session.commit()
+
+        self.assertEqual(roll_show_counters(since), ({1}, {1}))
+        db.session.commit()
+        venue = Venue.query.get(1)
+        self.assertEqual(venue.upcoming_shows_count, 0)
+        self.assertEqual(venue.past_shows_count, 1)
+
+    def test_search_ranks_name_matches_first(self):
+        db.session.add(Venue(name='Blue Moon', city='Austin', state='TX',
+                             genres=['Jazz']))
+        db.session.add(Venue(name='The Hall', city='Bluefield', state='WV',
+                             genres=['Blues']))
+        db.session.commit()
+        total, results = search_entities(Venue, 'blue')
+
+        self.assertEqual(total, 2)
+        self.assertEqual(results[0].name, 'Blue Moon')
+
+    def test_search_matches_city_and_genres(self):
+        self.seed(10)
+        total, results = search_entities(Venue, 'city 3 jaz', per_page=1)
+
+        self.assertEqual(total, 2)
+        self.assertEqual(len(results), 1)
+
+    def test_search_venues_page(self):
+        self.seed(3)
+        res = self.client().post('/venues/search',
+                                 data={'search_term': 'venue 1'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Venue 1', res.data)
+
+    def test_search_bad_page(self):
+        self.seed(1)
+        for url in ('/venues/search', '/artists/search'):
+            for page in (0, -1):
+                res = self.client().post(url, data={'search_term': 'a',
+                                                    'page': page})
+                self.assertEqual(res.status_code, 400)
+
+    def test_typeahead_artists(self):
+        self.seed(1)
+        res = self.client().get('/artists/typeahead?q=art')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), [{'id': 1, 'name': 'Artist'}])
+
+    def test_shows_keyset_pages(self):
+        self.seed(5, shows_per_venue=10)
+        seen = []
+        url = '/shows.json?limit=7'
+        while url:
+            data = self.client().get(url).get_json()
+            seen.extend(data['shows'])
+            cursor = data['next_cursor']
+            url = cursor and '/shows.json?limit=7&after=' + cursor
+
+        self.assertEqual(len(seen), 50)
+        start_times = [show['start_time'] for show in seen]
+        self.assertEqual(start_times, sorted(start_times))
+
+    def test_shows_query_count_is_constant(self):
+        self.seed(2)
+        small = self.count_queries('/shows')
+        self.seed(50)
+        large = self.count_queries('/shows')
+
+        self.assertEqual(small, large)
+
+    def test_shows_stream(self):
+        self.seed(3, shows_per_venue=4)
+        res = self.client().get('/shows.json?stream=1')
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 12)
+        html = self.client().get('/shows?stream=1').get_data(as_text=True)
+        self.assertEqual(html.count('tile-show'), 12)
+
+    def test_shows_bad_cursor(self):
+        res = self.client().get('/shows?after=nonsense')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_shows_bad_limit(self):
+        self.seed(1)
+        for url in ('/shows', '/shows.json'):
+            for limit in (0, -1):
+                res = self.client().get('%s?limit=%d' % (url, limit))
+                self.assertEqual(res.status_code, 400)
+
+    def test_format_datetime(self):
+        value = datetime(2020, 5, 21, 21, 30)
+
+        self.assertEqual(format_datetime(value, 'full'),
+                         'Thursday May, 21, 2020 at 9:30PM')
+        self.assertEqual(format_datetime(str(value), 'full'),
+                         format_datetime(value, 'full'))
+        self.assertEqual(format_datetimes([value, str(value)], 'medium'),
+                         [format_datetime(value)] * 2)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', 4, timeout=0)
+        self.assertIsNone(cache.get('d'))
+
+    def test_detail_page_is_cached(self):
+        self.seed(1)
+        page_cache.clear()
+        self.client().get('/venues/1')
+        with QueryCounter(db.engine) as counter:
+            res = self.client().get('/venues/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(counter.count, 0)
+        self.assertGreaterEqual(page_cache.stats()['hits'], 1)
+
+    def test_edit_venue_invalidates_pages(self):
+        self.seed(1)
+        self.client().get('/venues')
+        self.client().get('/artists/1')
+        self.client().post('/venues/1/edit', data={
+            'name': 'Renamed', 'city': 'Austin', 'state': 'TX',
+            'address': '1 Main St', 'phone': '', 'genres': ['Jazz'],
+            'facebook_link': ''})
+
+        self.assertIsNone(page_cache.backend.get('venues'))
+        self.assertIsNone(page_cache.backend.get('venue:1'))
+        self.assertIsNone(page_cache.backend.get('artist:1'))
+        self.assertIn(b'Renamed', self.client().get('/venues').data)
+
+    def test_cache_metrics(self):
+        res = self.client().get('/metrics/cache')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hits', res.get_json())
+
+    def create_venue(self, i):
+        start = time.perf_counter()
+        res = self.client().post('/venues/create', data={
+            'name': 'Parallel %d' % i, 'city': 'Austin', 'state': 'TX',
+            'address': '1 Main St', 'phone': '', 'genres': ['Jazz'],
+            'facebook_link': ''})
+        self.assertEqual(res.status_code, 200)
+        return time.perf_counter() - start
+
+    def test_parallel_creates_do_not_collide(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(self.create_venue, range(80)))
+        ids = [id for id, in db.session.query(Venue.id)]
+
+        self.assertEqual(len(ids), 80)
+        self.assertEqual(len(set(ids)), 80)
+
+    def test_bulk_insert_allocates_id_blocks(self):
+        first = allocate_ids(Venue, 3)
+        second = allocate_ids(Venue, 2)
+        ids = bulk_insert(Venue, [{'name': 'Bulk %d' % i} for i in range(4)])
+        db.session.commit()
+
+        self.assertEqual(len(set(first + second)), 5)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(Venue.query.count(), 4)
+
+    def test_import_venues_csv(self):
+        body = ('name,city,state,address,phone,genres,facebook_link\n'
+                'Hall,Austin,TX,1 Main St,,"Jazz,Blues",https://fb.com/hall\n'
+                ',Austin,TX,1 Main St,,Jazz,https://fb.com/x\n'
+                'Bar,Austin,ZZ,1 Main St,,Jazz,https://fb.com/bar\n')
+        res = self.client().post('/import/venues?format=csv', data=body,
+                                 content_type='text/csv')
+        report = res.get_json()
+
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['rejected'], 2)
+        self.assertEqual([error['line'] for error in report['errors']], [2, 3])
+        self.assertIn('name', report['errors'][0]['errors'])
+        self.assertIn('state', report['errors'][1]['errors'])
+        self.assertEqual(Venue.query.one().genres, ['Jazz', 'Blues'])
+        self.assertEqual(search_entities(Venue, 'hall')[0], 1)
+
+    def test_import_url_rule_matches_wtforms(self):
+        urls = ['https://fb.com/hall', 'http://127.0.0.1:80/x', 'http://1.2.3',
+                'https://bücher.de', 'http://xn--p1ai.xn--p1ai', 'fb.com',
+                'http://a_b-c.example?q=1', 'http://-a.com', 'http://a..com',
+                'http://localhost', 'http://%s.com' % ('a' * 64), '']
+        for validator in (URL(), URL(require_tld=False)):
+            rule = URLRule(validator)
+            for url in urls:
+                results = []
+                for check in (validator, rule):
+                    try:
+                        check(None, RowField(url))
+                        results.append(None)
+                    except ValidationError as error:
+                        results.append(str(error))
+                self.assertEqual(results[0], results[1], url)
+
+    def test_import_shows_jsonl(self):
+        self.seed(1, shows_per_venue=0)
+        day = datetime(2099, 1, 1)
+        add_availability(1, day, day + timedelta(days=1))
+        db.session.commit()
+        body = '\n'.join([
+            '{"artist_id": 1, "venue_id": 1, "start_time": "2099-01-01 20:00:00"}',
+            '{"artist_id": 1, "venue_id": 9, "start_time": "2099-01-01 20:00:00"}',
+            '{"artist_id": 1, "venue_id": 1, "start_time": "tomorrow"}',
+            'not json',
+            '{"artist_id": 1, "venue_id": 1, "start_time": "2099-01-01 20:00:00"}'])
+        res = self.client().post('/import/shows', data=body,
+                                 content_type='application/x-ndjson')
+        report = res.get_json()
+
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['rejected'], 4)
+        self.assertEqual(report['errors'][-1], {'line': 5, 'errors': {
+            'start_time': ['Artist already plays another show at that time',
+                           'Venue is already booked at that time']}})
+        self.assertEqual(Venue.query.get(1).upcoming_shows_count, 1)
+
+    def test_facets_follow_writes(self):
+        self.create_venue(0)
+        self.create_venue(1)
+        self.client().post('/import/venues?format=csv', content_type='text/csv',
+                           data='name,city,state,address,phone,genres,'
+                                'facebook_link\nHall,Dallas,TX,1 Main St,,'
+                                '"Jazz,Blues",https://fb.com/hall\n')
+        self.client().post('/venues/1/edit', data={
+            'name': 'Parallel 0', 'city': 'Austin', 'state': 'TX',
+            'address': '1 Main St', 'phone': '', 'genres': ['Folk'],
+            'facebook_link': ''})
+        self.client().delete('/venues/2')
+        facets = get_facets(Venue)
+
+        self.assertEqual(facets['genre'], [
+            {'value': 'Blues', 'count': 1}, {'value': 'Folk', 'count': 1},
+            {'value': 'Jazz', 'count': 1}])
+        self.assertEqual(facets['state'], [{'value': 'TX', 'count': 2}])
+        self.assertEqual(facets['city'], [
+            {'value': 'Austin', 'count': 1}, {'value': 'Dallas', 'count': 1}])
+        rebuild_facets(Venue)
+        self.assertEqual(get_facets(Venue), facets)
+
+    def test_browse_filters_by_genre_and_area(self):
+        self.seed(7)
+        Venue.query.filter(Venue.id.in_([2, 4, 6])).update(
+            {Venue.genres: ['Jazz', 'Folk']}, synchronize_session=False)
+        rebuild_facets(Venue)
+        db.session.commit()
+        with QueryCounter(db.engine) as counter:
+            res = self.client().get('/browse/venues?genre=Jazz&genre=Folk'
+                                    '&state=TX')
+        page = res.get_json()
+
+        self.assertEqual(counter.count, 2)
+        self.assertEqual([venue['id'] for venue in page['data']], [2, 4, 6])
+        self.assertIsNone(page['next_after'])
+        self.assertEqual(page['facets']['genre'], [
+            {'value': 'Jazz', 'count': 7}, {'value': 'Folk', 'count': 3}])
+        res = self.client().get('/browse/venues?city=City 1&after=2')
+        self.assertEqual([venue['id'] for venue in res.get_json()['data']],
+                         [7])
+        self.assertEqual(self.client().get('/browse/shows').status_code, 404)
+
+    def test_browse_matches_every_genre(self):
+        self.seed(3)
+        for venue_id, genres in [(1, ['Jazz']), (2, ['Rock']),
+                                 (3, ['Jazz', 'Rock'])]:
+            Venue.query.get(venue_id).genres = genres
+        db.session.commit()
+
+        for query in ('genre=Jazz&genre=Rock', 'genre=Rock&genre=Jazz'):
+            res = self.client().get('/browse/venues?' + query)
+            self.assertEqual([venue['id'] for venue in res.get_json()['data']],
+                             [3])
+
+    def test_sql_profiler_reports_queries(self):
+        self.seed(3)
+        app.config['SQL_PROFILER'] = True
+        try:
+            with self.assertLogs(app.logger, 'INFO') as logs:
+                res = self.client().get('/venues')
+        finally:
+            app.config['SQL_PROFILER'] = False
+        record = json.loads(logs.records[-1].getMessage())
+
+        self.assertRegex(res.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="1 queries"$')
+        self.assertEqual(record['path'], '/venues')
+        self.assertEqual(record['queries'], 1)
+        self.assertEqual(record['repeated'], [])
+        self.assertNotIn('Server-Timing', self.client().get('/venues').headers)
+
+    def test_sql_profiler_flags_repeated_statements(self):
+        profiled = Flask('profiled')
+        profiled.config['SQL_PROFILER'] = True
+        SQLProfiler(profiled)
+        engine = create_engine('sqlite://')
+
+        @profiled.route('/')
+        def one_query_per_row():
+            for i in range(6):
+                engine.execute('SELECT ?', i)
+            return ''
+
+        with self.assertLogs(profiled.logger, 'WARNING') as logs:
+            res = profiled.test_client().get('/')
+        record = json.loads(logs.records[-1].getMessage())
+
+        self.assertIn('desc="6 queries"', res.headers['Server-Timing'])
+        self.assertEqual(record['repeated'],
+                         [{'statement': 'SELECT ?', 'count': 6}])
+
+    def test_sql_profiler_enables_info_logs(self):
+        profiled = Flask('profiled_logs')
+        profiled.config['SQL_PROFILER'] = True
+        SQLProfiler(profiled)
+        plain = Flask('plain_logs')
+        plain.config['SQL_PROFILER'] = False
+        SQLProfiler(plain)
+
+        self.assertEqual(profiled.logger.level, logging.INFO)
+        self.assertEqual(plain.logger.level, logging.NOTSET)
+
+    def test_sql_profiler_counts_failed_statements(self):
+        profiled = Flask('profiled_errors')
+        profiled.config['SQL_PROFILER'] = True
+        SQLProfiler(profiled)
+        engine = create_engine('sqlite://')
+
+        @profiled.route('/')
+        def failing_query():
+            with engine.connect() as connection:
+                try:
+                    connection.execute('SELECT * FROM missing')
+                except Exception:
+                    pass
+                starts = connection.info.get('profile_start')
+            return str(len(starts))
+
+        res = profiled.test_client().get('/')
+
+        self.assertEqual(res.data, b'0')
+        self.assertIn('desc="1 queries"', res.headers['Server-Timing'])
+
+    def test_logging_starts_with_served_requests(self):
+        debug = app.debug
+        app.debug = False
+        try:
+            self.client().get('/')
+        finally:
+            app.debug = debug
+
+        # Tests and imports never start the writer thread
+        self.assertIsNone(fyyur.log_writer)
+
+    def logged_app(self, **config):
+        """A bare app logging through setup_logging() into a temp dir"""
+        logged = Flask('logged_%d' % len(config))
+        logged.config['LOG_FILE'] = os.path.join(tempfile.mkdtemp(), 'app.log')
+        logged.config.update(config)
+        return logged, setup_logging(logged)
+
+    def test_async_logging_writes_json_lines(self):
+        logged, writer = self.logged_app(LOG_LEVEL='DEBUG',
+                                         LOG_DEBUG_SAMPLE_RATE=0)
+        for i in range(3):
+            logged.logger.info('request %d', i)
+        for i in range(100):
+            logged.logger.debug('show %d', i)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logged.logger.exception('failed')
+        writer.stop()
+        with open(logged.config['LOG_FILE']) as log_file:
+            entries = [json.loads(line) for line in log_file]
+
+        self.assertEqual([entry['message'] for entry in entries],
+                         ['request 0', 'request 1', 'request 2', 'failed'])
+        self.assertEqual(entries[-1]['level'], 'ERROR')
+        self.assertIn('ZeroDivisionError', entries[-1]['exception'])
+        self.assertEqual(writer.queue_handler.dropped, 0)
+
+    def test_async_logging_rotates(self):
+        logged, writer = self.logged_app(LOG_MAX_BYTES=2000,
+                                         LOG_BACKUP_COUNT=2)
+        for i in range(200):
+            logged.logger.warning('line %d', i)
+        writer.stop()
+
+        path = logged.config['LOG_FILE']
+        self.assertTrue(os.path.exists(path + '.2'))
+        self.assertFalse(os.path.exists(path + '.3'))
+        self.assertLessEqual(os.path.getsize(path + '.1'), 2000)
+
+    def test_static_select_matches_wtforms(self):
+        venue = Venue(name='Hall', state='TX', genres=['Jazz', 'R&B'])
+        with app.test_request_context():
+            for form in (VenueForm(obj=venue), ArtistForm(), VenueForm()):
+                for field, multiple in ((form.state, False),
+                                        (form.genres, True)):
+                    self.assertEqual(field(class_='form-control'),
+                                     Select(multiple)(field,
+                                                      class_='form-control'))
+
+    def test_edit_forms_are_populated(self):
+        self.seed(1)
+        venue_html = self.client().get('/venues/1/edit').get_data(as_text=True)
+        artist_html = self.client().get('/artists/1/edit').get_data(as_text=True)
+
+        self.assertIn('value="Venue 0"', venue_html)
+        self.assertIn('<option selected value="Jazz">', venue_html)
+        self.assertIn('<option selected value="TX">', venue_html)
+        self.assertIn('value="Austin"', artist_html)
+        self.assertEqual(venue_html.count(' selected '), 2)
+
+    def test_compile_templates(self):
+        directory = tempfile.mkdtemp()
+        try:
+            result = app.test_cli_runner().invoke(
+                args=['compile-templates', '--directory', directory])
+            cache = app.jinja_env.bytecode_cache
+            template = app.jinja_env.loader.get_source(app.jinja_env,
+                                                       'pages/venues.html')
+            bucket = cache.get_bucket(app.jinja_env, 'pages/venues.html',
+                                      template[1], template[0])
+        finally:
+            app.jinja_env.bytecode_cache = None
+            app.jinja_env.cache.clear()
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(len(os.listdir(directory)), len(template_names()))
+        self.assertIsNotNone(bucket.code)
+
+    def copy_static(self):
+        static_dir = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(app.static_folder, static_dir,
+                        ignore=shutil.ignore_patterns('dist'))
+        return static_dir
+
+    def test_minify_css(self):
+        css = ('/*! keep */\n/* drop */\na > b ,\n c {\n  color: red ;\n'
+               '  content: "a , b";\n}\n')
+        self.assertEqual(minify_css(css),
+                         '/*! keep */ a>b,c{color:red;content:"a , b"}')
+
+    def test_build_assets(self):
+        static_dir = self.copy_static()
+        manifest = build_assets(static_dir)
+        path = os.path.join(static_dir, manifest['main.css'])
+        with open(path, 'rb') as bundle, open(path + '.gz', 'rb') as packed:
+            content = bundle.read()
+            self.assertEqual(gzip.decompress(packed.read()), content)
+        sources = sum(os.path.getsize(os.path.join(static_dir, source))
+                      for source in BUNDLES['main.css'])
+
+        self.assertEqual(sorted(manifest), sorted(BUNDLES))
+        self.assertRegex(manifest['main.css'], r'^dist/main\.[0-9a-f]{12}\.css$')
+        self.assertLess(len(content), sources)
+        with open(os.path.join(static_dir, 'css/main.css'), 'a') as source:
+            source.write('.changed { color: red; }')
+        rebuilt = build_assets(static_dir)
+        self.assertNotEqual(rebuilt['main.css'], manifest['main.css'])
+        self.assertEqual(rebuilt['head.js'], manifest['head.js'])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_built_assets_are_served_immutable(self):
+        static_folder = app.static_folder
+        app.static_folder = self.copy_static()
+        try:
+            asset_manifest.update(build_assets(app.static_folder))
+            html = self.client().get('/').get_data(as_text=True)
+            url = '/static/' + asset_manifest['main.css']
+            packed = self.client().get(url, headers={
+                'Accept-Encoding': 'gzip, deflate'})
+            plain = self.client().get(url)
+        finally:
+            app.static_folder = static_folder
+            asset_manifest.clear()
+
+        self.assertIn('href="%s"' % url, html)
+        self.assertNotIn('/static/css/main.css', html)
+        self.assertEqual(packed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(packed.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', packed.headers['Vary'])
+        self.assertEqual(gzip.decompress(packed.data), plain.data)
+        self.assertEqual(plain.mimetype, 'text/css')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_add_availability_merges_slots(self):
+        self.seed(1, shows_per_venue=0)
+        day = datetime(2099, 1, 1)
+        add_availability(1, day, day + timedelta(hours=4))
+        db.session.flush()
+        add_availability(1, day + timedelta(hours=2), day + timedelta(hours=8))
+        db.session.commit()
+        slot = Availability.query.one()
+
+        self.assertEqual((slot.start_time, slot.end_time),
+                         (day, day + timedelta(hours=8)))
+
+    def test_create_show_checks_conflicts(self):
+        self.seed(1, shows_per_venue=0)
+        day = datetime(2099, 1, 1, 12)
+        add_availability(1, day, day + timedelta(hours=12))
+        db.session.commit()
+        form = {'artist_id': '1', 'venue_id': '1',
+                'start_time': '2099-01-01 18:00:00'}
+        self.client().post('/shows/create', data=form)
+        self.client().post('/shows/create',
+                           data=dict(form, start_time='2099-01-01 19:00:00'))
+        self.client().post('/shows/create',
+                           data=dict(form, start_time='2099-01-02 19:00:00'))
+
+        self.assertEqual(Show.query.count(), 1)
+        self.assertEqual(booking_conflicts(1, 1, datetime(2099, 1, 1, 19)), [
+            'Artist already plays another show at that time',
+            'Venue is already booked at that time'])
+
+    def test_new_shows_refresh_venue_listing(self):
+        self.seed(1, shows_per_venue=0)
+        day = datetime(2099, 1, 1, 12)
+        add_availability(1, day, day + timedelta(hours=12))
+        db.session.commit()
+        self.client().get('/venues')
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1',
+            'start_time': '2099-01-01 18:00:00'})
+
+        self.assertIsNone(page_cache.get('venues'))
+
+        # The clock moves past the show, the periodic job rolls it over
+        Show.query.update({Show.start_time: datetime.now()})
+        db.session.commit()
+        self.client().get('/venues')
+        self.assertIsNotNone(page_cache.get('venues'))
+        app.test_cli_runner().invoke(args=['roll-show-counters'])
+
+        self.assertIsNone(page_cache.get('venues'))
+        self.assertEqual(Venue.query.get(1).past_shows_count, 1)
+
+    def test_check_schedule(self):
+        self.seed(2, shows_per_venue=0)
+        day = datetime(2099, 1, 1)
+        add_availability(1, day, day + timedelta(days=1))
+        db.session.commit()
+        res = self.client().post('/shows/check', json=[
+            {'artist_id': 1, 'venue_id': 1, 'start_time': '2099-01-01 10:00'},
+            {'artist_id': 1, 'venue_id': 2, 'start_time': '2099-01-01 15:00'},
+            {'artist_id': 1, 'venue_id': 2, 'start_time': '2099-01-01 16:00'},
+            {'artist_id': 1, 'venue_id': 1, 'start_time': '2099-01-03 10:00'}])
+        conflicts = [result['conflicts'] for result in res.get_json()]
+
+        self.assertEqual(conflicts[0], [])
+        self.assertEqual(len(conflicts[1]), 2)
+        self.assertEqual(len(conflicts[2]), 2)
+        self.assertEqual(conflicts[3], ['Artist not available at that time'])
+
+    def test_times_with_timezone_are_rejected(self):
+        self.seed(1, shows_per_venue=0)
+        res = self.client().post('/shows/check', json=[
+            {'artist_id': 1, 'venue_id': 1,
+             'start_time': '2030-01-01T20:00:00Z'}])
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1',
+            'start_time': '2030-01-01T20:00:00Z'})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Show.query.count(), 0)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_logging_latency_benchmark(self):
+        self.seed(20)
+        client = self.client()
+        directory = tempfile.mkdtemp()
+
+        class SlowFile:
+            """A log file whose flushes wait like a busy disk"""
+
+            def __init__(self, stream, delay):
+                self.stream = stream
+                self.delay = delay
+
+            def write(self, text):
+                self.stream.write(text)
+
+            def flush(self):
+                time.sleep(self.delay)
+                self.stream.flush()
+
+            def __getattr__(self, name):
+                return getattr(self.stream, name)
+
+        def latency(handler):
+            # Every request logs its SQL profile, like a production request
+            # logging a line or two
+            app.logger.addHandler(handler)
+            app.logger.setLevel('INFO')
+            try:
+                client.get('/venues')
+                start = time.perf_counter()
+                for i in range(1000):
+                    client.get('/venues')
+                return (time.perf_counter() - start) / 1000
+            finally:
+                app.logger.removeHandler(handler)
+
+        def compare(delay):
+            file_handler = logging.FileHandler(os.path.join(directory, 'old.log'))
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '
+                '[in %(pathname)s:%(lineno)d]'))
+            file_handler.stream = SlowFile(file_handler.stream, delay)
+            before = latency(file_handler)
+            file_handler.close()
+            logged, writer = self.logged_app()
+            writer.handler.stream = SlowFile(writer.handler._open(), delay)
+            after = latency(writer.queue_handler)
+            writer.stop()
+            print('\n/venues latency with %.1fms flushes: %.3fms with '
+                  'FileHandler, %.3fms with AsyncLogWriter'
+                  % (delay * 1000, before * 1000, after * 1000))
+            return before, after
+
+        app.config['SQL_PROFILER'] = True
+        try:
+            compare(0)
+            before, after = compare(0.0005)
+        finally:
+            app.config['SQL_PROFILER'] = False
+            app.logger.setLevel('NOTSET')
+
+        self.assertLess(after, before)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_template_cold_start_benchmark(self):
+        self.seed(1)
+        db.session.remove()
+        # A fresh worker: import the app, then time its first requests
+        script = '''if True:
+            import time
+            start = time.perf_counter()
+            from app import app
+            imported = time.perf_counter()
+            client = app.test_client()
+            for url in ('/', '/venues', '/venues/1', '/venues/1/edit',
+                        '/artists/create', '/shows'):
+                client.get(url)
+            print(imported - start, time.perf_counter() - imported)
+        '''
+        directory = tempfile.mkdtemp()
+
+        def cold_start(cache_dir):
+            env = dict(os.environ)
+            env.pop('TEMPLATE_CACHE_DIR', None)
+            if cache_dir:
+                env['TEMPLATE_CACHE_DIR'] = cache_dir
+            timings = []
+            for i in range(5):
+                output = subprocess.run(
+                    [sys.executable, '-c', script], env=env, check=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    capture_output=True, text=True).stdout
+                timings.append([float(value) for value in output.split()])
+            return [min(column) for column in zip(*timings)]
+
+        before = cold_start(None)
+        app.test_cli_runner().invoke(
+            args=['compile-templates', '--directory', directory])
+        app.jinja_env.bytecode_cache = None
+        app.jinja_env.cache.clear()
+        after = cold_start(directory)
+        print('\nCold start, import + first requests: %.0f + %.0fms without '
+              'the bytecode cache, %.0f + %.0fms with it'
+              % tuple(value * 1000 for value in before + after))
+
+        # Import time varies more between runs than the cache saves, only
+        # the first requests are compared
+        self.assertLess(after[1], before[1])
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_booking_benchmark(self):
+        self.seed(1, shows_per_venue=0)
+        day = datetime(2099, 1, 1)
+        bulk_insert(Availability, [
+            {'artist_id': 1, 'start_time': day + timedelta(days=i),
+             'end_time': day + timedelta(days=i, hours=12)}
+            for i in range(5000)])
+        db.session.commit()
+        times = [day + timedelta(days=i * 7 % 5000, hours=2)
+                 for i in range(1000)]
+
+        start = time.perf_counter()
+        for start_time in times:
+            self.assertEqual(booking_conflicts(1, 1, start_time), [])
+        single = (time.perf_counter() - start) / len(times)
+        start = time.perf_counter()
+        results = check_schedule([(1, 1, start_time) for start_time in times])
+        batch = (time.perf_counter() - start) / len(times)
+        print('\nbooking check: %.3fms single, %.3fms batched'
+              % (single * 1000, batch * 1000))
+
+        self.assertEqual(len(results), len(times))
+        self.assertLess(batch, single)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_import_throughput(self):
+        rows = [{'name': 'Venue %d' % i, 'city': 'Austin', 'state': 'TX',
+                 'address': '%d Main St' % i, 'phone': '', 'genres': 'Jazz,Folk',
+                 'facebook_link': 'https://www.facebook.com/venue%d' % i}
+                for i in range(100000)]
+        start = time.perf_counter()
+        report = run_import('venues', iter(rows))
+        rate = len(rows) / (time.perf_counter() - start)
+        print('\nimport: %d rows/s' % rate)
+
+        self.assertEqual(report['imported'], len(rows))
+        # The adapted target, see bulk_import.py
+        self.assertGreater(rate, TARGET_ROWS_PER_SECOND)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_create_latency_is_flat(self):
+        bulk_insert(Venue, [{'name': 'Seed %d' % i} for i in range(100)])
+        db.session.commit()
+        small = sum(map(self.create_venue, range(50))) / 50
+        bulk_insert(Venue, [{'name': 'Seed %d' % i} for i in range(100000)])
+        db.session.commit()
+        large = sum(map(self.create_venue, range(50))) / 50
+        print('\ncreate latency: %.2fms at 100 rows, %.2fms at 100k rows'
+              % (small * 1000, large * 1000))
+
+        self.assertLess(large, small * 3)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_shows_formatting_benchmark(self):
+        import babel.dates
+        import dateutil.parser
+        values = [datetime(2020, 1, 1) + timedelta(hours=i)
+                  for i in range(10000)]
+        pattern = "EEEE MMMM, d, y 'at' h:mma"
+
+        start = time.perf_counter()
+        for value in values:
+            babel.dates.format_datetime(dateutil.parser.parse(str(value)),
+                                        pattern)
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        format_datetimes(values, 'full')
+        after = time.perf_counter() - start
+        print('\n/shows formatting of %d rows: %.1fms before, %.1fms after'
+              % (len(values), before * 1000, after * 1000))
+
+        self.assertLess(after, before)
+
+    @unittest.skipUnless(BENCHMARK, 'set FYYUR_BENCHMARK to run benchmarks')
+    def test_search_index_benchmark(self):
+        index = InvertedIndex({'name': 3, 'city': 2, 'genres': 1})
+        for i in range(1000000):
+            index.add(i, {'name': 'Venue %d' % i, 'city': 'City %d' % (i % 1000),
+                          'genres': 'Genre%d' % (i % 20)})
+        start = time.perf_counter()
+        for i in range(100):
+            index.search('venue %d' % (i * 9973), limit=20)
+        elapsed = (time.perf_counter() - start) / 100
+
+        self.assertLess(elapsed, 0.01)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Read-only views against a second SQLite file standing in for a replica"""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_BINDS'] = {'replica_0': 'sqlite:///' +
+            os.path.join(tempfile.mkdtemp(), 'fyyur_replica.db')}
+        self.client = app.test_client
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.replica = db.get_engine(app, bind='replica_0')
+        db.Model.metadata.create_all(self.replica)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.Model.metadata.drop_all(self.replica)
+        app.config['SQLALCHEMY_BINDS'] = {}
+        search_indexes.clear()
+        page_cache.clear()
+        self.ctx.pop()
+
+    def add_venue(self, engine, name):
+        engine.execute(Venue.__table__.insert(), {'name': name, 'city': 'Austin',
+                                                  'state': 'TX'})
+
+    def test_read_only_views_use_replica(self):
+        self.add_venue(db.engine, 'Primary Hall')
+        self.add_venue(self.replica, 'Replica Hall')
+
+        html = self.client().get('/venues').get_data(as_text=True)
+        self.assertIn('Replica Hall', html)
+        self.assertNotIn('Primary Hall', html)
+        res = self.client().post('/venues/search', data={'search_term': 'hall'})
+        self.assertIn('Replica Hall', res.get_data(as_text=True))
+        html = self.client().get('/venues/1/edit').get_data(as_text=True)
+        self.assertIn('Primary Hall', html)
+
+    def test_writes_go_to_primary_and_stick(self):
+        client = app.test_client()
+        client.post('/venues/create', data={
+            'name': 'New Hall', 'city': 'Austin', 'state': 'TX',
+            'address': '1 Main St', 'phone': '', 'genres': ['Jazz'],
+            'facebook_link': ''})
+
+        self.assertEqual(Venue.query.one().name, 'New Hall')
+        self.assertEqual(self.replica.execute(
+            'SELECT count(*) FROM "Venue"').scalar(), 0)
+        self.assertIn('New Hall', client.get('/venues').get_data(as_text=True))
+        page_cache.clear()
+        html = app.test_client().get('/venues').get_data(as_text=True)
+        self.assertNotIn('New Hall', html)
+
+    def test_replica_pages_are_not_cached(self):
+        self.add_venue(db.engine, 'Primary Hall')
+        self.client().get('/venues')
+
+        self.assertIsNone(page_cache.get('venues'))
+        with self.client() as client:
+            with client.session_transaction() as sess:
+                sess['primary_until'] = time.time() + 60
+            html = client.get('/venues').get_data(as_text=True)
+        self.assertIn('Primary Hall', html)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
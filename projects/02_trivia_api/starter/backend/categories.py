@@ -0,0 +1,76 @@
+import hashlib
+import json
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from models import Category
+
+# Seconds the categories are kept before they are read again, which bounds
+# how long changes made by other processes take to show
+CATEGORY_TTL = 300
+
+
+def category_changed(mapper, connection, target):
+    if has_app_context():
+        registry = current_app.extensions.get('categories')
+        if registry is not None:
+            registry.invalidate()
+
+
+for change in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Category, change, category_changed)
+
+
+class CategoryRegistry:
+    """
+    The {id: type} dict of the categories, read once and shared by every
+    request of the process. It is read again after CATEGORY_TTL seconds, or
+    as soon as this process writes a category. `etag` changes with the
+    content, so every process hands out the same one for the same categories.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.categories = None
+        self.etag = None
+        self.loaded_at = 0
+        # Bumped on every write, a load that raced one is not kept
+        self.version = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CATEGORY_TTL', CATEGORY_TTL)
+        app.extensions['categories'] = self
+
+    def load(self):
+        with self.lock:
+            version = self.version
+        categories = {category.id: category.type
+                      for category in Category.query.all()}
+        etag = hashlib.sha1(json.dumps(
+            sorted(categories.items())).encode()).hexdigest()
+        with self.lock:
+            if version == self.version:
+                self.categories = categories
+                self.etag = etag
+                self.loaded_at = time.monotonic()
+        return categories, etag
+
+    def get(self):
+        """Returns (categories, etag), the dict must not be changed"""
+        with self.lock:
+            categories, etag = self.categories, self.etag
+            fresh = time.monotonic() - self.loaded_at < \
+                current_app.config['CATEGORY_TTL']
+        if categories is None or not fresh:
+            return self.load()
+        return categories, etag
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.categories = None
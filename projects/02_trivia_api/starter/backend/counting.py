@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+# Seconds a cached count is trusted before it is read again from the
+# database, which bounds how stale writes from other processes leave it
+COUNT_TTL = 60
+
+listening = False
+listening_lock = threading.Lock()
+
+
+def current_counter():
+    if has_app_context():
+        return current_app.extensions.get('row_counter')
+    return None
+
+
+def after_flush(session, flush_context):
+    # The new and deleted collections still hold what was just flushed
+    delta = session.info.setdefault('row_count_delta', Counter())
+    for instance in session.new:
+        delta[type(instance)] += 1
+    for instance in session.deleted:
+        delta[type(instance)] -= 1
+
+
+def after_commit(session):
+    delta = session.info.pop('row_count_delta', None)
+    counter = current_counter()
+    if delta and counter is not None:
+        counter.apply(delta)
+
+
+def after_rollback(session):
+    session.info.pop('row_count_delta', None)
+
+
+def after_bulk_delete(delete_context):
+    # Query.delete() skips the session, the count has to be read again
+    counter = current_counter()
+    if counter is not None:
+        counter.invalidate(delete_context.mapper.class_)
+
+
+def listen():
+    """Hooks every session, once, the first time a cached count is read"""
+    global listening
+    with listening_lock:
+        if not listening:
+            event.listen(Session, 'after_flush', after_flush)
+            event.listen(Session, 'after_commit', after_commit)
+            event.listen(Session, 'after_rollback', after_rollback)
+            event.listen(Session, 'after_bulk_delete', after_bulk_delete)
+            listening = True
+
+
+class RowCounter:
+    """
+    Counts the rows of a model's table with SELECT COUNT(*). With the
+    ROW_COUNT_CACHE config key (or environment variable) set, counts are kept
+    in process and moved along with the inserts and deletes this process
+    commits, and read again after ROW_COUNT_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.counts = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ROW_COUNT_CACHE', bool(
+            os.environ.get('ROW_COUNT_CACHE')))
+        app.config.setdefault('ROW_COUNT_TTL', COUNT_TTL)
+        app.extensions['row_counter'] = self
+
+    def query(self, model):
+        return model.query.session.query(func.count()).select_from(
+            model).scalar()
+
+    def count(self, model):
+        if not current_app.config['ROW_COUNT_CACHE']:
+            return self.query(model)
+        listen()
+        with self.lock:
+            cached = self.counts.get(model)
+        if cached is not None and \
+                time.monotonic() - cached[1] < \
+                current_app.config['ROW_COUNT_TTL']:
+            return cached[0]
+        count = self.query(model)
+        with self.lock:
+            self.counts[model] = (count, time.monotonic())
+        return count
+
+    def apply(self, delta):
+        with self.lock:
+            for model, change in delta.items():
+                if model in self.counts:
+                    count, read_at = self.counts[model]
+                    self.counts[model] = (count + change, read_at)
+
+    def invalidate(self, model):
+        with self.lock:
+            self.counts.pop(model, None)
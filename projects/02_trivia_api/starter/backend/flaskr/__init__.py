@@ -1,18 +1,77 @@
 import os
+import base64
+import binascii
 from flask import Flask, request, abort, jsonify, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
 from models import setup_db, Question, Category, db
+from sql_profiler import SQLProfiler
+from counting import RowCounter
+from categories import CategoryRegistry
+from search import search_questions
+from quiz import QuizSessions, question_ids, random_question, SESSION_TTL
 
 QUESTIONS_PER_PAGE = 10
 
 
+def encode_cursor(question_id):
+    """Opaque token for a position, the last question id or a search offset"""
+    return base64.urlsafe_b64encode(str(question_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Reverses encode_cursor(), raises ValueError for a bad token"""
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def paginate(query, page=1, cursor=None):
+    """
+    Fetches one page of a Question query, ordered by id, and formats only
+    that page. Pages are picked with LIMIT/OFFSET, or after a `cursor` from a
+    previous response, which stays as cheap for deep pages as for the first.
+    Returns (questions, next_cursor), next_cursor is None on the last page.
+    """
+    query = query.order_by(Question.id)
+    if cursor is not None:
+        query = query.filter(Question.id > decode_cursor(cursor))
+    else:
+        query = query.offset(page_offset(page))
+    # One extra row tells whether there is a next page
+    questions = query.limit(QUESTIONS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(questions) > QUESTIONS_PER_PAGE:
+        questions = questions[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(questions[-1].id)
+    return [question.format() for question in questions], next_cursor
+
+
+def page_offset(page):
+    if page < 1:
+        raise ValueError('Invalid page')
+    return (page - 1) * QUESTIONS_PER_PAGE
+
+
+def get_page_args():
+    """The page number and cursor of the request"""
+    return int(request.args.get('page', 1)), request.args.get('cursor')
+
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     setup_db(app)
+    # Opt in with SQL_PROFILER=1, see sql_profiler.py
+    SQLProfiler(app)
+    # Question totals, cached in process with ROW_COUNT_CACHE=1
+    counter = RowCounter(app)
+    # {id: type} of the categories, read once per CATEGORY_TTL
+    categories = CategoryRegistry(app)
+    quizzes = QuizSessions(int(os.environ.get('QUIZ_SESSION_TTL',
+                                              SESSION_TTL)))
     CORS(app, resources={r"*": {"origins": "*"}})
 
     @app.after_request
@@ -23,20 +82,6 @@ def create_app(test_config=None):
             'Access-Control-Allow-Methods', 'GET, POST, DELETE')
         return response
 
-    def paginate(selection, page):
-        """
-        This function is used to get the required questions per page.
-        By just changing the QUESTIONS_PER_PAGE variable will change
-        the number of questions you get per page
-        """
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-
-        questions = [question.format() for question in selection]
-        current_questions = questions[start:end]
-
-        return current_questions
-
     @app.route('/categories', methods=['GET'])
     def get_categories():
         """
@@ -44,19 +89,23 @@ def create_app(test_config=None):
         database
         """
         try:
-            categories = Category.query.all()
-            # To check if the category query returns something or not
-            if len(categories) > 0:
-                category_formatted = {
-                    category.id: category.type for category in categories}
-                result = {
-                    "success": True,
-                    "categories": category_formatted
-                }
-                return jsonify(result)
-            abort(404)
+            category_formatted, etag = categories.get()
         except Exception:
             abort(422)
+        # To check if the category query returns something or not
+        if len(category_formatted) == 0:
+            abort(404)
+        # Clients and proxies that have these categories get a bodyless 304
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({
+                "success": True,
+                "categories": category_formatted
+            })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
 
     @app.route("/questions", methods=['GET'])
     def get_questions():
@@ -64,13 +113,11 @@ def create_app(test_config=None):
         Returns the questions from the database
         """
         try:
-            page = int(request.args.get('page', 1))
-            categories = Category.query.all()
-            category_formatted = {
-                category.id: category.type for category in categories}
-            questions = Question.query.all()
-            total_questions = len(questions)
-            questions_query = paginate(questions, page)
+            page, cursor = get_page_args()
+            category_formatted, _ = categories.get()
+            total_questions = counter.count(Question)
+            questions_query, next_cursor = paginate(Question.query, page,
+                                                    cursor)
         except Exception:
             abort(422)
         if len(questions_query) == 0:
@@ -80,7 +127,8 @@ def create_app(test_config=None):
                 "questions": questions_query,
                 "total_questions": total_questions,
                 "categories": category_formatted,
-                "current_category": None
+                "current_category": None,
+                "next_cursor": next_cursor
         }
         return jsonify(result)
 
@@ -91,8 +139,10 @@ def create_app(test_config=None):
         id.
         """
         try:
-            q = Question.query.filter_by(id=question_id).first().format()
-            Question.query.filter_by(id=question_id).delete()
+            question = Question.query.get(question_id)
+            q = question.format()
+            # Deleted through the session so the cached count follows
+            db.session.delete(question)
             db.session.commit()
             result = {
                 "success": True,
@@ -123,11 +173,10 @@ def create_app(test_config=None):
             # adding the question created into the database
             db.session.add(question)
             db.session.commit()
-            questions_query = Question.query.all()
             result = {
                 "success": True,
                 "question": question.format(),
-                "total_questions": len(questions_query),
+                "total_questions": counter.count(Question),
                 "current_category": category
             }
             return jsonify(result)
@@ -142,32 +191,35 @@ def create_app(test_config=None):
     @app.route("/questions/search", methods=['POST'])
     def get_questions_substring():
         """
-        Checks if the given phrase is in any Question table's question column in
-        database
+        Full text search of the questions and answers, best match first, in
+        the category given, if any. See search.py
         """
-        total_questions = 0
         try:
             data = request.get_json()
             search_term = data['searchTerm']
-            query_string = "%" + search_term + "%"
-            # checks if searchTerm exists in the the Questions table
-            questions = Question.query.filter(
-                Question.question.ilike(query_string)).all()
-            total_questions = len(Question.query.all())
-            categories = Category.query.all()
+            category_id = int(data.get('category') or 0)
+            category_formatted, _ = categories.get()
+            page, cursor = get_page_args()
+            # Results are ranked, a cursor is the offset of the next page
+            offset = decode_cursor(cursor) if cursor is not None \
+                else page_offset(page)
+            questions, total_questions = search_questions(
+                search_term, category_id, offset, QUESTIONS_PER_PAGE + 1)
         except Exception:
             abort(422)
-        category_formatted = {
-            category.id: category.type for category in categories}
-        page = int(request.args.get('page', 1))
-        paginated_questions = paginate(questions, page)
+        next_cursor = None
+        if len(questions) > QUESTIONS_PER_PAGE:
+            questions = questions[:QUESTIONS_PER_PAGE]
+            next_cursor = encode_cursor(offset + QUESTIONS_PER_PAGE)
+        paginated_questions = [question.format() for question in questions]
         if len(paginated_questions) != 0:
             result = {
                 "success": "True",
                 "questions": paginated_questions,
                 "total_questions": total_questions,
                 "categories": category_formatted,
-                "current_category": None
+                "current_category": category_id or None,
+                "next_cursor": next_cursor
             }
             return jsonify(result)
         else:
@@ -179,67 +231,89 @@ def create_app(test_config=None):
         Gets all the question from a given category
         """
         try:
-            category_id = str(category_id)
-            page = int(request.args.get('page', 1))
-            questions = Question.query.filter_by(category=category_id).all()
-            total_questions = len(Question.query.all())
-            if len(questions) > 0:
-                paginated_questions = paginate(questions, page)
-                result = {
-                    "success": True,
-                    "questions": paginated_questions,
-                    "total_questions": total_questions,
-                    "current_category": category_id
-                }
-                return jsonify(result)
+            page, cursor = get_page_args()
+            # Joined on the foreign key, the questions are a range of
+            # ix_questions_category_id
+            questions = Question.query.join(
+                Category, Question.category == Category.id).filter(
+                Category.id == category_id)
+            total_questions = counter.count(Question)
+            paginated_questions, next_cursor = paginate(questions, page,
+                                                        cursor)
+        except Exception:
+            abort(422)
+        if len(paginated_questions) == 0:
             abort(404)
+        result = {
+            "success": True,
+            "questions": paginated_questions,
+            "total_questions": total_questions,
+            # A string, as before category was an integer column
+            "current_category": str(category_id),
+            "next_cursor": next_cursor
+        }
+        return jsonify(result)
+
+    def play_session(data):
+        """
+        Starts a quiz session for quiz_category, or plays the next round of
+        the quiz_session token. question is null once every one was asked.
+        """
+        try:
+            token = data.get('quiz_session')
+            quiz_category = data.get('quiz_category')
+            if token is None:
+                token = quizzes.start(int(quiz_category['id']))
         except Exception:
             abort(422)
+        try:
+            question = quizzes.next_question(str(token))
+        except KeyError:
+            # Unknown or expired, the client has to start a new quiz
+            abort(404)
+        return jsonify({
+            "success": True,
+            "question": question.format() if question else None,
+            "quiz_session": token,
+            "quiz_category": quiz_category
+        })
 
     @app.route('/play', methods=['POST'])
     def play():
         """
-        Used to start the game
+        Used to start the game. Without previous_questions a server side quiz
+        session is started, whose token is then all the next rounds send.
         """
-        data = request.get_json()
-        previous_questions = data['previous_questions']
-        quiz_category = data['quiz_category']
-        category_id = int(quiz_category['id'])
+        data = request.get_json(silent=True) or {}
+        if 'previous_questions' not in data:
+            return play_session(data)
         try:
-            # Checking if quiz_category is "ALL" or not to set the questions
-            # variable by getting the questions from database
-            if category_id != 0:
-                questions = Question.query.filter_by(
-                    category=str(category_id)).all()
-            else:
-                questions = Question.query.all()
-            available_questions = []
-            # To get the questions that are not already used
-            for question in questions:
-                if question.format() not in previous_questions:
-                    available_questions.append(question)
-            if len(available_questions) > 0:
-                # randomly selects a questions from available_questions
-                rand_question = available_questions[random.randint(
-                    0, len(available_questions)-1)]
-                previous_questions.append(rand_question.format())
-                return jsonify({
-                    "success": True,
-                    "question": rand_question.format(),
-                    "previous_questions": previous_questions,
-                    'quiz_category': quiz_category
-                })
-            else:
-                return jsonify({
-                    "success": True,
-                    'question': 'There are no more questions in this category. '
-                                + 'Try another category!',
-                    "previous_questions": previous_questions,
-                    'quiz_category': quiz_category
-                })
-            abort(404)
+            quiz_category = data['quiz_category']
+            category_id = int(quiz_category['id'])
+            previous_questions = data['previous_questions']
+            if not isinstance(previous_questions, list):
+                raise ValueError('previous_questions must be a list')
+            # Only the ids are compared, as a set, in the database query
+            question = random_question(category_id,
+                                       question_ids(previous_questions))
         except Exception:
             abort(422)
+        if question is None:
+            return jsonify({
+                "success": True,
+                'question': 'There are no more questions in this category. '
+                            + 'Try another category!',
+                "previous_questions": previous_questions,
+                'quiz_category': quiz_category
+            })
+        # Echoed as sent, with the new question appended as before
+        previous_questions.append(question.format())
+        return jsonify({
+            "success": True,
+            "question": question.format(),
+            "previous_questions": previous_questions,
+            'quiz_category': quiz_category
+        })
 
     @app.errorhandler(404)
     def page_not_found(error):
@@ -0,0 +1,33 @@
+--
+-- Turns questions.category into an integer foreign key to categories.id,
+-- indexed with id so a category's questions are an index range. Databases
+-- loaded from trivia.psql only miss the index, the statements that are
+-- already done do nothing. Run it once:
+--
+--     psql trivia < migrate_category.sql
+--
+
+BEGIN;
+
+-- Tables created by an older models.py store the id as a string
+ALTER TABLE public.questions
+    ALTER COLUMN category TYPE integer USING category::integer;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'public.questions'::regclass AND contype = 'f'
+    ) THEN
+        ALTER TABLE public.questions
+            ADD CONSTRAINT category FOREIGN KEY (category)
+            REFERENCES public.categories(id)
+            ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id
+    ON public.questions USING btree (category, id);
+
+COMMIT;
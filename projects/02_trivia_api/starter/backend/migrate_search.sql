@@ -0,0 +1,13 @@
+--
+-- Adds the full text index of the questions and answers that
+-- /questions/search uses on Postgres. Databases loaded from trivia.psql
+-- already have it. It is built without blocking writes, so it cannot run
+-- in a transaction. Run it once:
+--
+--     psql trivia < migrate_search.sql
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_search
+    ON public.questions USING gin (
+        to_tsvector('english', coalesce(question, '') || ' ' ||
+                               coalesce(answer, '')));
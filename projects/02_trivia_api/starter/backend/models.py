@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -25,17 +25,21 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # A category's questions in id order are a range of this index
+  __table_args__ = (Index('ix_questions_category_id', 'category', 'id'),)
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE',
+                                       ondelete='SET NULL'))
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
-    self.category = category
+    # Clients used to send the category id as a string
+    self.category = int(category)
     self.difficulty = difficulty
 
   def insert(self):
@@ -54,7 +58,8 @@ class Question(db.Model):
       'id': self.id,
       'question': self.question,
       'answer': self.answer,
-      'category': self.category,
+      # A string, as when the column was one
+      'category': None if self.category is None else str(self.category),
       'difficulty': self.difficulty
     }
 
@@ -0,0 +1,132 @@
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+from models import Question
+
+# Seconds a quiz session lives after its last round
+SESSION_TTL = 30 * 60
+# Sessions kept at most, the ones closest to expiring are dropped first
+MAX_SESSIONS = 10000
+# Random ids tried per round before counting the remaining questions
+SAMPLE_ATTEMPTS = 20
+
+
+def question_ids(previous_questions):
+    """
+    The ids of the questions already asked. Clients send either ids or the
+    question objects this API returns. Raises ValueError for anything else.
+    """
+    ids = set()
+    for question in previous_questions:
+        if isinstance(question, dict):
+            question = question['id']
+        ids.add(int(question))
+    return ids
+
+
+def category_questions(category_id):
+    """Questions of a category, all of them for category 0"""
+    if category_id == 0:
+        return Question.query
+    return Question.query.filter_by(category=category_id)
+
+
+def random_question(category_id, seen=()):
+    """
+    A random question of the category that is not in `seen`, or None when
+    every one was asked. Every remaining question is equally likely.
+
+    An id is drawn between the category's smallest and largest and looked
+    up, one probe of the (category, id) index, and drawn again when it is
+    missing, seen or of another category. Only a sparse or nearly exhausted
+    category gets past SAMPLE_ATTEMPTS draws, then the remaining questions
+    are counted and one is read at a random offset, which scans them.
+    """
+    query = category_questions(category_id)
+    # Apart, as SQLite only reads a lone min() or max() off the index
+    low = query.with_entities(func.min(Question.id)).scalar()
+    high = query.with_entities(func.max(Question.id)).scalar()
+    if low is None:
+        return None
+    for _ in range(SAMPLE_ATTEMPTS):
+        question_id = random.randint(low, high)
+        if question_id in seen:
+            continue
+        question = query.filter(Question.id == question_id).first()
+        if question is not None:
+            return question
+    if seen:
+        query = query.filter(~Question.id.in_(seen))
+    count = query.count()
+    if count == 0:
+        return None
+    return query.order_by(Question.id).offset(
+        random.randrange(count)).limit(1).first()
+
+
+class QuizSessions:
+    """
+    Server side quizzes. A session is the ids of its category's questions in
+    a random order, as an array of ints, and the position of the next one,
+    so each round only sends the session token. Sessions live in process,
+    with several workers a client has to keep talking to the same one.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        # token -> [question ids, position, expiry], soonest expiry first:
+        # every round moves its session to the end with the latest one
+        self.sessions = OrderedDict()
+
+    def evict(self, now):
+        """Drops expired sessions and makes room for one more"""
+        while self.sessions:
+            token, session = next(iter(self.sessions.items()))
+            if session[2] > now and len(self.sessions) < self.max_sessions:
+                break
+            del self.sessions[token]
+
+    def start(self, category_id):
+        """Shuffles the questions of the category, returns the new token"""
+        ids = array('l', (question_id for question_id, in
+                          category_questions(category_id).with_entities(
+                              Question.id)))
+        random.shuffle(ids)
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            # Read under the lock, so the order of the sessions is theirs
+            now = time.monotonic()
+            self.evict(now)
+            self.sessions[token] = [ids, 0, now + self.ttl]
+        return token
+
+    def next_question(self, token):
+        """
+        The next question of the session, None when it ran out. Raises
+        KeyError for an unknown or expired token.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                session = self.sessions.get(token)
+                if session is None or session[2] <= now:
+                    self.sessions.pop(token, None)
+                    raise KeyError(token)
+                ids, position = session[0], session[1]
+                if position == len(ids):
+                    return None
+                session[1] += 1
+                session[2] = now + self.ttl
+                self.sessions.move_to_end(token)
+            question = Question.query.get(ids[position])
+            # Deleted since the session started
+            if question is not None:
+                return question
@@ -0,0 +1,144 @@
+import re
+import threading
+
+from sqlalchemy import func, literal_column
+from sqlalchemy.sql import column, table
+
+from models import db, Question
+
+# Full text index of the question and answer. On Postgres the GIN index
+# ix_questions_search of trivia.psql and migrate_search.sql, which
+# rank_postgresql() repeats the expression of word for word to use it.
+# On SQLite an FTS5 table, kept in sync with questions by triggers
+SQLITE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+        question, answer, content='questions', content_rowid='id',
+        tokenize='porter unicode61')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_fts_insert AFTER INSERT
+    ON questions BEGIN
+        INSERT INTO questions_fts (rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_fts_delete AFTER DELETE
+    ON questions BEGIN
+        INSERT INTO questions_fts (questions_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_fts_update AFTER UPDATE
+    ON questions BEGIN
+        INSERT INTO questions_fts (questions_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO questions_fts (rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    # Indexes the rows that were there before the table
+    "INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')",
+]
+
+questions_fts = table('questions_fts', column('rowid'), column('rank'),
+                      column('questions_fts'))
+
+# Engine -> backend() of it, filled on the first search
+backends = {}
+backends_lock = threading.Lock()
+
+
+def search_words(search_term):
+    """The words of a search term, lower cased"""
+    return re.findall(r'\w+', search_term.lower())
+
+
+def backend():
+    """'postgresql', 'sqlite' or None for a substring search"""
+    engine = db.engine
+    with backends_lock:
+        if engine not in backends:
+            backends[engine] = create_index(engine)
+    return backends[engine]
+
+
+def create_index(engine):
+    """
+    Postgres' index comes with the schema, building it here would block the
+    search and writes to questions. Only SQLite's FTS5 table is created.
+    """
+    name = engine.dialect.name
+    if name == 'postgresql':
+        return name
+    if name != 'sqlite':
+        return None
+    with engine.begin() as connection:
+        if not connection.execute(
+                "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar():
+            return None
+        if not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'questions_fts'"
+                ).scalar():
+            for statement in SQLITE_INDEX:
+                connection.execute(statement)
+    return name
+
+
+def rank_postgresql(query, words):
+    """None when every word is a stopword, which Postgres does not index"""
+    document = func.to_tsvector(
+        literal_column("'english'"),
+        func.coalesce(Question.question, '') + ' ' +
+        func.coalesce(Question.answer, ''))
+    # Every word has to match, the last one may be unfinished
+    terms = func.to_tsquery(literal_column("'english'"),
+                            ' & '.join(words) + ':*')
+    if not db.session.query(func.numnode(terms)).scalar():
+        return None
+    rank = func.ts_rank(document, terms)
+    return query.filter(document.op('@@')(terms)), [rank.desc()]
+
+
+def rank_sqlite(query, words):
+    # FTS5 ranks with bm25, best match first. Words are only letters and
+    # digits, so none of them is an FTS5 operator.
+    query = query.join(questions_fts, questions_fts.c.rowid == Question.id) \
+        .filter(questions_fts.c.questions_fts.match(' '.join(words) + '*'))
+    return query, [questions_fts.c.rank]
+
+
+def search_questions(search_term, category_id=None, offset=0, limit=10):
+    """
+    Questions whose question or answer contains every word of
+    `search_term`, the last one possibly unfinished, best match first.
+    Postgres uses the full text index above, SQLite an FTS5 table. Other
+    databases, terms without words such as '?' and, on Postgres, terms
+    made only of stopwords such as 'what is' fall back to a substring match
+    of the question text in id order.
+    Returns (questions, total), at most `limit` questions from `offset`.
+    """
+    query = Question.query
+    if category_id:
+        query = query.filter(Question.category == category_id)
+    words = search_words(search_term)
+    name = backend() if words else None
+    ranked = None
+    if name == 'postgresql':
+        ranked = rank_postgresql(query, words)
+    elif name == 'sqlite':
+        ranked = rank_sqlite(query, words)
+    if ranked is not None:
+        query, order = ranked
+    else:
+        query = query.filter(Question.question.ilike(
+            '%' + search_term + '%'))
+        order = []
+    # The window runs before the page is cut, so it sees every match
+    rows = query.add_columns(func.count().over().label('total')) \
+        .order_by(*order).order_by(Question.id) \
+        .offset(offset).limit(limit).all()
+    total = rows[0].total if rows else 0
+    return [row[0] for row in rows], total
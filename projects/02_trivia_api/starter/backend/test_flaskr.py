@@ -1,10 +1,19 @@
 import os
+import random
+import tempfile
+import time
 import unittest
 import json
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import setup_db, Question, Category, db
+from search import search_questions
+from quiz import QuizSessions, random_question
+
+# Benchmarks are slow, they only run with TRIVIA_BENCHMARK set
+BENCHMARK = os.environ.get('TRIVIA_BENCHMARK')
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -37,6 +46,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def test_categories_not_modified(self):
+        res = self.client().get('/categories')
+        cached = self.client().get(
+            '/categories', headers={'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.data, b'')
+        self.assertEqual(cached.headers['ETag'], res.headers['ETag'])
+
     def test_get_questions(self):
         res = self.client().get('/questions?page=1')
         data = json.loads(res.data)
@@ -89,6 +107,19 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
 
+    def test_category_ids_stay_strings(self):
+        res = self.client().post('/questions', json={"question": "Typed?",
+                                                     "answer": "yes",
+                                                     "category": "2",
+                                                     "difficulty": 1})
+        question = json.loads(res.data)['question']
+        with self.app.app_context():
+            stored = Question.query.get(question['id']).category
+
+        self.client().delete('/questions/{}'.format(question['id']))
+        self.assertEqual(stored, 2)
+        self.assertEqual(question['category'], "2")
+
     def test_play(self):
         res = self.client().post('/play', json={"previous_questions": [],
                                                 "quiz_category":
@@ -100,6 +131,134 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertTrue(data['quiz_category'])
 
+    def test_play_skips_previous_questions(self):
+        with self.app.app_context():
+            ids = [question.id for question in
+                   Question.query.filter_by(category=1).all()]
+        res = self.client().post('/play', json={"previous_questions": ids[1:],
+                                                "quiz_category":
+                                                {"type": "Science", "id": 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], ids[0])
+        self.assertEqual(data['previous_questions'],
+                         ids[1:] + [data['question']])
+
+    def test_play_session(self):
+        res = self.client().post('/play', json={"quiz_category":
+                                                {"type": "Science", "id": 1}})
+        data = json.loads(res.data)
+        token = data['quiz_session']
+        asked = [data['question']['id']]
+        while data['question']:
+            data = json.loads(self.client().post(
+                '/play', json={"quiz_session": token}).data)
+            if data['question']:
+                asked.append(data['question']['id'])
+
+        with self.app.app_context():
+            ids = [question.id for question in
+                   Question.query.filter_by(category=1).all()]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(asked), sorted(ids))
+
+    def test_quiz_sessions_evict_soonest_expiry(self):
+        quizzes = QuizSessions(max_sessions=2)
+        with self.app.app_context():
+            first = quizzes.start(1)
+            second = quizzes.start(1)
+            # A round pushes the first session's expiry past the second's
+            quizzes.next_question(first)
+            third = quizzes.start(1)
+
+            self.assertEqual(list(quizzes.sessions), [first, third])
+            with self.assertRaises(KeyError):
+                quizzes.next_question(second)
+
+    def test_404_play_unknown_session(self):
+        res = self.client().post('/play', json={"quiz_session": "expired"})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['error'], 404)
+        self.assertEqual(data['success'], False)
+
+    def test_sql_profiler_server_timing(self):
+        self.app.config['SQL_PROFILER'] = True
+        res = self.client().get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertRegex(res.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries"$')
+
+    def test_get_questions_cursor(self):
+        first = json.loads(self.client().get('/questions').data)
+        res = self.client().get(
+            '/questions?cursor={}'.format(first['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'], json.loads(
+            self.client().get('/questions?page=2').data)['questions'])
+        self.assertGreater(data['questions'][0]['id'],
+                           first['questions'][-1]['id'])
+
+    def test_422_bad_cursor(self):
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['error'], 422)
+        self.assertEqual(data['success'], False)
+
+    def test_search_counts_matches(self):
+        res = self.client().post('/questions/search',
+                                 json={"searchTerm": "?"})
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            matches = Question.query.filter(
+                Question.question.ilike('%?%')).count()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], matches)
+
+    def test_search_ranks_questions_and_answers(self):
+        res = self.client().post('/questions', json={
+            "question": "Which searchable bird cannot fly?",
+            "answer": "Penguin", "category": 1, "difficulty": 1})
+        question = json.loads(res.data)['question']
+        data = json.loads(self.client().post('/questions/search', json={
+            "searchTerm": "searchable pengu", "category": 1}).data)
+        other = self.client().post('/questions/search', json={
+            "searchTerm": "searchable penguin", "category": 2})
+
+        self.client().delete('/questions/{}'.format(question['id']))
+        self.assertEqual(data['questions'][0], question)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(other.status_code, 404)
+
+    def test_search_stopwords(self):
+        res = self.client().post('/questions/search',
+                                 json={"searchTerm": "what is"})
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            matches = Question.query.filter(
+                Question.question.ilike('%what is%')).count()
+        self.assertEqual(data['total_questions'], matches)
+
+    def test_cached_question_count(self):
+        self.app.config['ROW_COUNT_CACHE'] = True
+        total = json.loads(self.client().get('/questions').data)[
+            'total_questions']
+        data = json.loads(self.client().post('/questions', json={
+            "question": "Counted?", "answer": "yes", "category": 1,
+            "difficulty": 1}).data)
+        self.assertEqual(data['total_questions'], total + 1)
+
+        self.client().delete('/questions/{}'.format(data['question']['id']))
+        data = json.loads(self.client().get('/questions').data)
+        self.assertEqual(data['total_questions'], total)
+
     def test_404_error(self):
         res = self.client().get('/questions?page=1000')
         data = json.loads(res.data)
@@ -117,6 +276,98 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], "Unprocessable Entity")
 
 
+@unittest.skipUnless(BENCHMARK, 'set TRIVIA_BENCHMARK to run')
+class SearchBenchmark(unittest.TestCase):
+    """Full text search against a substring match on a synthetic bank"""
+
+    questions = int(os.environ.get('TRIVIA_BENCHMARK_QUESTIONS', 1000000))
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' + os.path.join(
+            self.directory.name, 'bank.db'))
+        rng = random.Random(0)
+        self.words = ['w%05d' % i for i in range(20000)]
+        rows = ({"question": ' '.join(rng.choices(self.words, k=10)),
+                 "answer": ' '.join(rng.choices(self.words, k=2)),
+                 "category": str(rng.randint(1, 6)),
+                 "difficulty": rng.randint(1, 5)}
+                for _ in range(self.questions))
+        with self.app.app_context():
+            db.session.execute(Question.__table__.insert(), list(rows))
+            db.session.commit()
+            # Builds the index outside of the timings
+            search_questions('warm up')
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.directory.cleanup()
+
+    def timed(self, search):
+        terms = random.Random(1).sample(self.words, 50)
+        start = time.perf_counter()
+        for term in terms:
+            search(term)
+        return (time.perf_counter() - start) / len(terms) * 1000
+
+    def test_search(self):
+        def substring(term):
+            query = Question.query.filter(
+                Question.question.ilike('%' + term + '%'))
+            return query.order_by(Question.id).limit(10).all(), query.count()
+
+        with self.app.app_context():
+            fts = self.timed(search_questions)
+            like = self.timed(substring)
+        print('\n%d questions: full text %.2fms, substring %.2fms per search'
+              % (self.questions, fts, like))
+        self.assertLess(fts, like)
+
+
+
+@unittest.skipUnless(BENCHMARK, 'set TRIVIA_BENCHMARK to run')
+class QuizBenchmark(unittest.TestCase):
+    """Quiz round latency on a small and a large synthetic bank"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' + os.path.join(
+            self.directory.name, 'quiz.db'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.directory.cleanup()
+
+    def grow(self, questions):
+        rng = random.Random(questions)
+        db.session.execute(Question.__table__.insert(), [
+            {"question": "q", "answer": "a", "category": rng.randint(1, 6),
+             "difficulty": 1} for _ in range(questions)])
+        db.session.commit()
+
+    def round_ms(self, category_id):
+        """Average of the first 100 rounds of a quiz"""
+        seen = set()
+        start = time.perf_counter()
+        for _ in range(100):
+            seen.add(random_question(category_id, seen).id)
+        return (time.perf_counter() - start) / 100 * 1000
+
+    def test_round_latency_is_flat(self):
+        with self.app.app_context():
+            self.grow(1000)
+            small = [self.round_ms(category) for category in (0, 1)]
+            self.grow(1000000)
+            large = [self.round_ms(category) for category in (0, 1)]
+        print('\nquiz round: %.2f/%.2fms at 1k questions, %.2f/%.2fms at 1M'
+              % (small[0], small[1], large[0], large[1]))
+        for before, after in zip(small, large):
+            self.assertLess(after, before * 3)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -10,6 +10,7 @@ class QuizView extends Component {
     super();
     this.state = {
         quizCategory: null,
+        quizSession: null,
         previousQuestions: [], 
         showAnswer: false,
         categories: {},
@@ -52,10 +53,10 @@ class QuizView extends Component {
       type: "POST",
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory
-      }),
+      // The server keeps track of the questions asked in a quiz session
+      data: JSON.stringify(this.state.quizSession
+        ? {quiz_session: this.state.quizSession}
+        : {quiz_category: this.state.quizCategory}),
       xhrFields: {
         withCredentials: true
       },
@@ -63,6 +64,7 @@ class QuizView extends Component {
       success: (result) => {
         this.setState({
           showAnswer: false,
+          quizSession: result.quiz_session,
           previousQuestions: previousQuestions,
           currentQuestion: result.question,
           guess: '',
@@ -90,6 +92,7 @@ class QuizView extends Component {
   restartGame = () => {
     this.setState({
       quizCategory: null,
+      quizSession: null,
       previousQuestions: [], 
       showAnswer: false,
       numCorrect: 0,
@@ -6,9 +6,12 @@ from flask_cors import CORS
 
 from .database.models import *
 from .auth.auth import AuthError, requires_auth
+from .sql_profiler import SQLProfiler
 
 app = Flask(__name__)
 setup_db(app)
+# Opt in with SQL_PROFILER=1, see sql_profiler.py
+SQLProfiler(app)
 CORS(app)
 
 '''